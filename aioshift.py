@@ -0,0 +1,143 @@
+#############################################################################
+#
+# Copyright (C) 2018 Fabian Schweinfurth
+# Contact: autoshift <at> derfabbi.de
+#
+# This file is part of autoshift
+#
+# autoshift is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autoshift is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with autoshift.  If not, see <http://www.gnu.org/licenses/>.
+#
+#############################################################################
+"""asyncio front end for `ShiftClient`.
+
+Redemptions of different codes/platforms run concurrently (at most
+`concurrency` at a time) on top of the blocking `ShiftClient`, which
+keeps sharing its session, cookies and CSRF token between them.
+
+    aclient = AsyncShiftClient(ShiftClient(), concurrency=4)
+    statuses = aclient.run([("CODE1", "epic"), ("CODE2", "steam")])
+    # one lookup for all platforms of a code (see `ShiftClient.redeem_all`)
+    statuses = aclient.run([("CODE1", ["epic", "steam"])])
+
+As soon as one redemption comes back with `Status.TRYLATER` all
+redemptions that haven't posted their form yet are dropped.
+"""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from common import _L
+from shift import ShiftClient, Status
+
+
+class AsyncShiftClient:
+    def __init__(self, client=None, concurrency=4, **kwargs):
+        """`kwargs` are passed to `ShiftClient` if no `client` is given"""
+        self.client = client if client is not None else ShiftClient(**kwargs)
+        self.concurrency = max(1, concurrency)
+        self.executor = ThreadPoolExecutor(self.concurrency)
+        self.stopped = threading.Event()
+        self.__semaphore = None
+
+    def stop(self):
+        """Drop all redemptions that didn't post their form yet"""
+        if not self.stopped.is_set():
+            _L.debug("stopping all pending redemptions")
+        self.stopped.set()
+
+    async def __call(self, func, *args):
+        """Run blocking `func` in the executor (None if we were stopped)"""
+        if self.__semaphore is None:
+            self.__semaphore = asyncio.Semaphore(self.concurrency)
+        async with self.__semaphore:
+            if self.stopped.is_set():
+                return None
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self.executor, func, *args)
+
+    async def redeem(self, code, platform):
+        """Same as `ShiftClient.redeem`
+
+        Returns None if the redemption was dropped before it started"""
+        status = await self.__call(self.client.redeem, code, platform)
+        if status == Status.ABORTED:
+            return None
+        if status == Status.TRYLATER:
+            self.stop()
+        return status
+
+    async def redeem_all(self, code, platforms):
+        """Same as `ShiftClient.redeem_all`
+
+        Dropped platforms are left out. Returns None if all were dropped"""
+        statuses = await self.__call(self.client.redeem_all, code, platforms)
+        if statuses is None:
+            return None
+        statuses = {platform: status for platform, status in statuses.items()
+                    if status != Status.ABORTED}
+        if Status.TRYLATER in statuses.values():
+            self.stop()
+        return statuses or None
+
+    async def redeem_many(self, jobs, callback=None):
+        """Redeem all (code, platform) pairs in `jobs`
+
+        `platform` may be a list of platforms, which are redeemed with a
+        single code lookup (`redeem_all`, the status is a dict then).
+        `callback(index, status)` is called as soon as a redemption finished.
+        `jobs` may be an iterator. It is only advanced when a redemption
+        can start (in the calling thread) and not at all after a stop.
+        Returns the statuses of the started jobs in order (None for
+        dropped ones)"""
+        jobs = enumerate(jobs)
+        self.stopped.clear()
+        self.__semaphore = asyncio.Semaphore(self.concurrency)
+        results = []
+
+        async def worker():
+            while not self.stopped.is_set():
+                job = next(jobs, None)
+                if job is None:
+                    return
+                i, (code, platform) = job
+                results.append(None)
+                if isinstance(platform, str):
+                    status = await self.redeem(code, platform)
+                else:
+                    status = await self.redeem_all(code, platform)
+                results[i] = status
+                if callback is not None and status is not None:
+                    callback(i, status)
+
+        # only abort redemptions of this batch. `stopped` stays set
+        # until the next batch, the client is shared with others
+        previous = self.client.abort
+        self.client.abort = self.stopped
+        try:
+            await asyncio.gather(*[worker()
+                                   for _ in range(self.concurrency)])
+        finally:
+            self.client.abort = previous
+        return results
+
+    def run(self, jobs, callback=None):
+        """Blocking version of `redeem_many`"""
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.redeem_many(jobs, callback))
+        finally:
+            loop.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
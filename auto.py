@@ -22,15 +22,21 @@
 #############################################################################
 from __future__ import print_function
 import sys
+from collections import OrderedDict
+from itertools import groupby
+from operator import attrgetter
 
+import metrics
 import query
 from query import games, platforms # noqa
 # from query import BL3
-from shift import ShiftClient, Status
-from common import _L, INFO, DEBUG, DIRNAME
+from shift import ShiftClient, Status, SESSION_FILE
+from common import _L, INFO, DEBUG, DIRNAME, LOG_FORMATS, initLogger
 
 
 client = None
+aclient = None
+ratelimit = None
 
 LICENSE_TEXT = """\
 ========================================================================
@@ -42,8 +48,22 @@ under certain conditions; see LICENSE for details.
 """
 
 
-def redeem(key, platform):
-    """Redeem key and set as redeemed if successfull"""
+def redeem_all(rows):
+    """Redeem a code for all (platform, key) rows with a single lookup
+
+    Returns dict with the status of each platform"""
+    key = rows[0][1]
+    _L.info("Trying to redeem {} ({}) for {}"
+            .format(key.description, key.key,
+                    ", ".join(platform for platform, _ in rows)))
+    statuses = client.redeem_all(key.key, [platform for platform, _ in rows])
+    for platform, key in rows:
+        handle_status(key, statuses[platform])
+    return statuses
+
+
+def handle_status(key, status):
+    """Set key as redeemed (if it was) and notify user"""
     messages = {
         Status.SUCCESS: "Redeemed {key.description}",
         Status.EXPIRED: "This code expired by now.. ({key.description})",
@@ -53,10 +73,7 @@ def redeem(key, platform):
         Status.UNKNOWN: "A unknown Error occured",
         Status.NONE: "Something unexpected happened.."
     }
-
-    _L.info("Trying to redeem {} ({})".format(key.description, key.key))
-    status = client.redeem(key.key, platform)
-    _L.debug("Status: {}".format(Status(status)))
+    _L.debug("Status: %s", Status(status))
 
     # set redeemed status
     if status in (Status.SUCCESS, Status.REDEEMED,
@@ -69,32 +86,201 @@ def redeem(key, platform):
     return status == Status.SUCCESS
 
 
-def query_keys(games, platforms):
+def iter_codes(game, platforms, golden=None):
+    """Yield (code, [(platform, key), ...]) of the unredeemed keys of a game
+
+    Keys are streamed from the database in the order of `query.iter_keys`
+    (soonest expiring first, then newest first). The keys of one code are
+    inserted together, so only the current code is kept.
+    only golden keys if `golden` is True, only non-golden keys if False"""
+    requested = {}
+    for platform in platforms:
+        requested.setdefault(query.db_platform(platform), []).append(platform)
+
+    keys = query.iter_keys(platforms, game, golden=golden)
+    for code, group in groupby(keys, key=attrgetter("key")):
+        yield code, [(platform, key) for key in group
+                     for platform in requested[key.platform]]
+
+
+def plan_golden(args, tried=()):
+    """Pick the golden keys that give the most golden keys under `args.limit`
+
+    Returns [(code, [(platform, key), ...]), ...] (soonest expiring codes
+    first, then newest first. These are preferred on ties, too).
+    Redemptions in `tried` ((platform, key id) pairs) are left out"""
+    import planner
+
+    candidates = []
+    for game in args.games:
+        for code, rows in iter_codes(game, args.platforms, golden=True):
+            for platform, key in rows:
+                if (platform, key.id) not in tried:
+                    candidates.append((game, platform, key))
+
+    chosen = planner.plan([key.golden_count for _, _, key in candidates],
+                          max(0, args.limit))
+    codes = OrderedDict()
+    for i in chosen:
+        game, platform, key = candidates[i]
+        codes.setdefault((game, key.key), []).append((platform, key))
+
+    if _L.isEnabledFor(DEBUG):
+        total = sum(candidates[i][2].golden_count for i in chosen)
+        _L.debug("Plan: {} golden keys of {} allowed with {} of {} "
+                 "redemptions".format(total, args.limit, len(chosen),
+                                      len(candidates)))
+        for (game, code), rows in codes.items():
+            key = rows[0][1]
+            _L.debug("  {:4} {} {:2d} x {} ({})".format(
+                game.upper(), code, key.golden_count,
+                ", ".join(platform for platform, _ in rows),
+                key.description))
+    return [(code, rows) for (_, code), rows in codes.items()]
+
+
+def redeem_codes(codes, args, stop=None):
+    """Redeem (code, [(platform, key), ...]) one code after the other
+
+    Returns the number of redemptions that didn't succeed or None if we
+    had to stop (redemption limit or `stop`)"""
+    failed = 0
+    for code, rows in codes:
+        if stop is not None and stop.is_set():
+            _L.info("Stopped before redeeming all keys")
+            return None
+
+        # number of golden keys in this code
+        num_g_keys = rows[0][1].golden_count
+        statuses = redeem_all(rows)
+        redeemed = list(statuses.values()).count(Status.SUCCESS)
+        failed += len(statuses) - redeemed
+        if redeemed and num_g_keys:
+            args.limit -= num_g_keys * redeemed
+            _L.info("Redeeming another {} Keys".format(args.limit))
+
+        # don't spam if we reached the hourly limit
+        if Status.TRYLATER in statuses.values():
+            ratelimit.hit()
+            return None
+    return failed
+
+
+def redeem_concurrent(args, stop=None):
+    """Redeem keys with up to `args.concurrency` redemptions in flight
+
+    Returns True if we hit the redemption limit"""
+    global aclient
+    from aioshift import AsyncShiftClient
+
+    if not aclient:
+        aclient = AsyncShiftClient(client, args.concurrency)
+
+    # (code, [(platform, key), ...]) by job index until it is done.
+    # each code is looked up once
+    pending = {}
+    tried = set()
+    failed = 0
+
+    def submit(codes):
+        pending.clear()
+        for i, (code, rows) in enumerate(codes):
+            pending[i] = (code, rows)
+            yield code, [platform for platform, _ in rows]
+
+    def done(i, statuses):
+        nonlocal failed
+        code, rows = pending.pop(i)
+        key = rows[0][1]
+        _L.info("Tried to redeem {} ({}) for {}"
+                .format(key.description, code,
+                        ", ".join(platform for platform in statuses)))
+        for platform, key in rows:
+            # dropped before it was posted
+            if platform not in statuses:
+                continue
+            if handle_status(key, statuses[platform]):
+                if key.golden_count:
+                    args.limit -= key.golden_count
+                    _L.info("Redeeming another {} Keys".format(args.limit))
+            elif key.golden_count:
+                failed += 1
+        if stop is not None and stop.is_set():
+            aclient.stop()
+
+    # golden keys first (like `run`). They are planned before we know
+    # which ones succeed. plan again with what failed ones left of the limit
+    if not args.non_golden:
+        while True:
+            codes = plan_golden(args, tried)
+            if not codes:
+                break
+            for code, rows in codes:
+                tried.update((platform, key.id) for platform, key in rows)
+            failed = 0
+            aclient.run(submit(codes), done)
+            # stopped because of TRYLATER (or `stop`)
+            if aclient.stopped.is_set():
+                return not (stop is not None and stop.is_set())
+            if not failed:
+                break
+
+    if not args.golden:
+        # streamed from the database
+        codes = ((code, rows) for game in args.games
+                 for code, rows in iter_codes(game, args.platforms, False))
+        aclient.run(submit(codes), done)
+        if aclient.stopped.is_set():
+            return not (stop is not None and stop.is_set())
+    return False
+
+
+def report_rewards():
+    """Print rewards unlocked since the last report"""
+    if not client.track_rewards or client.old_rewards is None:
+        return
+    rewards = client.unlocked_rewards()
+    _L.info("Unlocked {} rewards".format(len(rewards)))
+    for reward in rewards:
+        _L.info("  {}".format(reward))
+    # start over for the next (scheduled) run
+    client.old_rewards = None
+
+
+def query_keys(games, platforms, force=False):
     """Query new keys for given games and platforms
 
-    Returns dict of dicts of lists with [game][platform] as keys"""
-    all_keys = {}
-    # query new keys
-    for game in games:
-        all_keys[game] = {}
-        for platform in platforms:
-            print("Parsing {:4} keys...".format(game.upper()), end="")
-            sys.stdout.flush()
-            keys = query.get_keys(platform, game, True)
+    Only sources that are due are fetched, unless `force` is set"""
+    query.reset_parsed()
+    # query new keys (of all games at once and only once for all platforms)
+    print("Parsing {} keys...".format(", ".join(g.upper() for g in games)),
+          end="")
+    sys.stdout.flush()
+    results = query.parse_all(games, force=force)
+    print("done.")
 
-            # parse all keys
-            query.parse_keys(game, platform)
+    # no need to ask SHiFT about those
+    retired = query.retire_expired()
+    if retired:
+        _L.info("Skipping {} expired keys".format(retired))
 
-            new_keys = query.get_keys(platform, game, True)
-            all_keys[game][platform] = new_keys
+    for game in games:
+        new, known = results.get(game, (0, 0))
+        print("{:4} keys: {} new ({:.2f}s)"
+              .format(game.upper(), new if new else "no",
+                      query.parse_times.get(game, 0)))
 
-            # count the new keys
-            diff = len(new_keys) - len(keys)
-            print("done. ({} new Keys)".format(diff if diff else "no"))
-            n_golden, g_keys = query.get_golden_keys(platform, game)
+        for platform in platforms:
+            n_golden = query.count_golden_keys(platform, game)
             print("You have {} golden {} keys to redeem for {}"
                   .format(n_golden, game.upper(), platform.upper()))
-    return all_keys
+
+    stats = query.fetch_stats
+    _L.info("Sources: {} not due, {} not modified, {} unchanged, {} parsed "
+            "({:.0f} kB not downloaded)"
+            .format(stats["skipped"], stats["hits"], stats["unchanged"],
+                    stats["misses"] - stats["unchanged"],
+                    stats["bytes_saved"] / 1024))
 
 
 def setup_argparser():
@@ -131,9 +317,63 @@ def setup_argparser():
                         Max number of golden Keys you want to redeem.
                         (default 200)
                         NOTE: You can only have 255 keys at any given time!""")) # noqa
+    parser.add_argument("--concurrency",
+                        type=int, default=1,
+                        help=("Number of codes to redeem at the same time "
+                              "(default 1)"))
+    parser.add_argument("--rewards",
+                        action="store_true",
+                        help=("Report the rewards that got unlocked "
+                              "after redeeming"))
     parser.add_argument("--schedule",
                         action="store_true",
                         help="Keep checking for keys and redeeming every hour")
+    parser.add_argument("--interval",
+                        type=int, default=65,
+                        help=("Minutes between two scheduled runs. "
+                              "Redeeming resumes as soon as the hourly "
+                              "limit allows (default 65)"))
+    parser.add_argument("--fetch-interval", dest="fetch_interval",
+                        type=int, default=20,
+                        help=("Minutes between two scheduled runs that only "
+                              "fetch new keys while waiting for the hourly "
+                              "limit to reset (default 20)"))
+    parser.add_argument("--refresh",
+                        action="store_true",
+                        help=("Fetch all sources, even those that were "
+                              "fetched recently"))
+    parser.add_argument("--daemon",
+                        action="store_true",
+                        help=("Like --schedule but keep the client and "
+                              "database open between runs. Reloads --config "
+                              "on SIGHUP and stops on SIGTERM/SIGINT"))
+    parser.add_argument("--config",
+                        default=None,
+                        help=("JSON file with settings for --daemon, e.g. "
+                              '{"games": ["bl3"], "limit": 30}'))
+    parser.add_argument("--status-port", dest="status_port",
+                        type=int, default=None,
+                        help=("Serve the state of --daemon as JSON on this "
+                              "port (/status and /health)"))
+    parser.add_argument("--outcomes",
+                        metavar="FILE", default=None,
+                        help=("Where to remember expired and invalid codes "
+                              "(shared by all accounts using it): a file or "
+                              "dynamodb:<table> (default: "
+                              "$AUTOSHIFT_OUTCOMES or data/outcomes.json)"))
+    parser.add_argument("--metrics-json", dest="metrics_json",
+                        metavar="FILE", default=None,
+                        help=("Write timings and counters of each run to "
+                              "this JSON file"))
+    parser.add_argument("--metrics-prom", dest="metrics_prom",
+                        metavar="FILE", default=None,
+                        help=("Write timings and counters of each run to "
+                              "this Prometheus textfile (*.prom)"))
+    parser.add_argument("--log-format", dest="log_format",
+                        choices=LOG_FORMATS, default=None,
+                        help=("color, json or logfmt (default: "
+                              "$AUTOSHIFT_LOG_FORMAT or auto: color on a "
+                              "terminal, logfmt otherwise)"))
     parser.add_argument("-v", dest="verbose",
                         action="store_true",
                         help="Verbose mode")
@@ -141,66 +381,117 @@ def setup_argparser():
     return parser
 
 
-def main(args):
-    global client
-    import re
+def setup(args):
+    """Create the client and rate limit state (once)"""
+    global client, ratelimit
+    from scheduler import RateLimit
 
     if not client:
-        client = ShiftClient(args.user, args.pw)
+        client = ShiftClient(args.user, args.pw, track_rewards=args.rewards,
+                             outcome_cache=args.outcomes)
+    if not ratelimit:
+        ratelimit = RateLimit()
+
+
+def main(args, fetch_only=False):
+    """Query new keys and redeem them
+
+    only query keys if `fetch_only` is set or we're still waiting for
+    the hourly redemption limit to reset"""
+    metrics.reset()
+    try:
+        setup(args)
+        query.open_db()
+        try:
+            run(args, fetch_only)
+        finally:
+            query.close_db()
+    finally:
+        export_metrics(args)
+
+
+def export_metrics(args):
+    """Write the metrics of the last run to the `--metrics-*` files"""
+    writers = ((getattr(args, "metrics_json", None), metrics.write_json),
+               (getattr(args, "metrics_prom", None), metrics.write_prometheus))
+    for filename, write in writers:
+        if not filename:
+            continue
+        try:
+            write(filename)
+        except (IOError, OSError) as e:
+            _L.error("Could not write metrics to {}: {}".format(filename, e))
 
-    g_reg = re.compile(r"^(\d+).*gold.*", re.I)
 
-    query.open_db()
+def run(args, fetch_only=False, stop=None):
+    """`main` with an open database
+
+    Stops after the current code once `stop` (`threading.Event`) is set"""
     # query all keys
-    all_keys = query_keys(args.games, args.platforms)
+    query_keys(args.games, args.platforms, args.refresh)
+
+    if fetch_only or ratelimit.limited():
+        _L.info("Waiting for the redemption limit to reset. "
+                "Not redeeming anything ...")
+        return
 
     # redeem 0 golden keys but only golden??... duh
     if not args.limit and args.golden:
         _L.info("Not redeeming anything ...")
         return
 
-    # now redeem
-    for game in all_keys.keys():
-        for platform in all_keys[game].keys():
-            t_keys = all_keys[game][platform]
-            for key in t_keys:
-                if key.redeemed:
-                    # we could query only unredeemed keys
-                    # but we have them already so it doesn't matter
-                    continue
-                num_g_keys = 0  # number of golden keys in this code
-                m = g_reg.match(key.description)
-
-                # skip keys we don't want
-                if ((args.golden and not m) or (args.non_golden and m)):
-                    continue
-
-                if m:
-                    num_g_keys = int(m.group(1))
-                    # skip golden keys if we reached the limit
-                    if args.limit <= 0:
-                        continue
-
-                    # skip if this code has too many golden keys
-                    if (args.limit - num_g_keys) < 0:
-                        continue
-
-                redeemed = redeem(key, platform)
-                if redeemed:
-                    args.limit -= num_g_keys
-                    _L.info("Redeeming another {} Keys".format(args.limit))
-                else:
-                    # don't spam if we reached the hourly limit
-                    if client.last_status == Status.TRYLATER:
-                        return
-
-    query.close_db()
+    ratelimit.clear()
+    if args.concurrency > 1:
+        if redeem_concurrent(args, stop):
+            ratelimit.hit()
+            report_rewards()
+            return
+    else:
+        # now redeem. each code is looked up once for all platforms
+        if not args.non_golden:
+            tried = set()
+            while True:
+                codes = plan_golden(args, tried)
+                if not codes:
+                    break
+                for code, rows in codes:
+                    tried.update((platform, key.id) for platform, key in rows)
+                failed = redeem_codes(codes, args, stop)
+                if failed is None:
+                    report_rewards()
+                    return
+                # failed redemptions left some of the limit. plan again
+                if not failed:
+                    break
+
+        if not args.golden:
+            codes = ((code, rows) for game in args.games
+                     for code, rows in iter_codes(game, args.platforms, False))
+            if redeem_codes(codes, args, stop) is None:
+                report_rewards()
+                return
+
+    report_rewards()
+    if not _L.isEnabledFor(DEBUG):
+        return
+    _L.debug("Reused CSRF token %d times, skipped %d lookups of dead codes",
+             client.token_fetches_saved, client.outcome_cache.hits)
+    if client.poll_stats:
+        done = [el[2] for el in client.poll_stats if el[3]]
+        _L.debug("%d status polls, %d fallbacks, %.2fs avg until done",
+                 len(client.poll_stats), client.poll_fallbacks,
+                 sum(done) / len(done) if done else 0)
+    stats = metrics.summary()
+    if "requests_per_code" in stats:
+        _L.debug("%d requests to SHiFT, %s per code",
+                 stats["counters"].get("shift.requests", 0),
+                 stats["requests_per_code"])
 
 
 if __name__ == "__main__":
     import os
     # only print license text on first use
-    if not os.path.exists(os.path.join(DIRNAME, "data", ".cookies.save")):
+    if not os.path.exists(os.path.join(DIRNAME, "data", SESSION_FILE)):
         print(LICENSE_TEXT)
 
     # build argument parser
@@ -209,26 +500,28 @@ if __name__ == "__main__":
 
     args.pw = getattr(args, "pass")
 
+    if args.log_format:
+        initLogger(args.log_format)
     _L.setLevel(INFO)
     if args.verbose:
         _L.setLevel(DEBUG)
         _L.debug("Debug mode on")
 
+    if args.daemon:
+        import daemon
+        daemon.Daemon(args).run()
+        sys.exit(0)
+
     # always execute at least once
     main(args)
 
-    # scheduling will start after first trigger (so in an hour..)
+    # scheduling will start after first trigger
+    # (in `--interval` minutes or as soon as we can redeem again)
     if args.schedule:
-        _L.info("Scheduling to run once an hour")
-        from apscheduler.schedulers.blocking import BlockingScheduler
-        scheduler = BlockingScheduler()
-        # fire every 1h5m
-        #  (5min safe margin because it somtimes fires a few seconds too early)
-        scheduler.add_job(main, "interval", args=(args,), hours=1, minutes=5)
+        import scheduler
+        _L.info("Scheduling to run every {} minutes".format(args.interval))
         print('Press Ctrl+{} to exit'.format('Break' if os.name == 'nt'
                                              else 'C'))
-
-        try:
-            scheduler.start()
-        except (KeyboardInterrupt, SystemExit):
-            pass
+        scheduler.run(lambda fetch_only: main(args, fetch_only),
+                      ratelimit, interval=args.interval * 60,
+                      fetch_interval=args.fetch_interval * 60)
@@ -0,0 +1,523 @@
+#!/usr/bin/env python
+#############################################################################
+#
+# Copyright (C) 2018 Fabian Schweinfurth
+# Contact: autoshift <at> derfabbi.de
+#
+# This file is part of autoshift
+#
+# autoshift is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autoshift is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with autoshift.  If not, see <http://www.gnu.org/licenses/>.
+#
+#############################################################################
+"""Micro benchmarks for the hot paths of autoshift.
+
+    ./bench.py extract          # html extraction (fixtures/shift/*.html)
+    ./bench.py redeem           # ShiftClient.redeem against fakeshift.py
+    ./bench.py orcz             # code table of a source (fixtures/orcz)
+    ./bench.py keys             # reading the key backlog from the database
+    ./bench.py plan             # picking golden keys under --limit
+    ./bench.py logging          # log calls of one redeemed code
+"""
+from __future__ import print_function
+from os import path
+from time import process_time, perf_counter
+
+from common import DIRNAME
+
+FIXTURES = path.join(DIRNAME, "fixtures")
+
+
+def fixture(*name):
+    with open(path.join(FIXTURES, *name)) as f:
+        return f.read()
+
+
+def measure(func, n):
+    """Run `func` n times. Returns (cpu, wall) seconds per call"""
+    t_cpu, t_wall = process_time(), perf_counter()
+    for _ in range(n):
+        func()
+    return ((process_time() - t_cpu) / n,
+            (perf_counter() - t_wall) / n)
+
+
+def bench_extract(args):
+    """Full BeautifulSoup parse (as before) vs. `extract`"""
+    from bs4 import BeautifulSoup as BSoup
+    import extract
+
+    new = fixture("shift", "code_redemptions_new.html")
+    offer = fixture("shift", "entitlement_offer_codes.html")
+    status = fixture("shift", "code_redemption_status.html")
+    rewards = fixture("shift", "rewards.html")
+
+    def bs_token():
+        soup = BSoup(new, "html.parser")
+        return soup.find("meta", attrs=dict(name="csrf-token"))["content"]
+
+    def bs_forms():
+        soup = BSoup(offer, "html.parser")
+        soup.find("form", class_="new_archway_code_redemption")
+        return [soup.find_all("input", attrs=dict(name="authenticity_token")),
+                soup.find_all(id="archway_code_redemption_code"),
+                soup.find_all(id="archway_code_redemption_check"),
+                soup.find_all(id="archway_code_redemption_service")]
+
+    def bs_status():
+        div = BSoup(status, "lxml").find("div", id="check_redemption_status")
+        return div.text.strip(), div["data-url"], div["data-fallback-url"]
+
+    def bs_rewards():
+        soup = BSoup(rewards, "html.parser")
+        return [el.text
+                for el in soup.find_all("div", class_="reward_unlocked")]
+
+    # sanity check: both ways have to find the same things
+    assert bs_token() == extract.csrf_token(new)
+    assert len(bs_forms()[3]) == len(extract.redemption_forms(offer))
+    assert list(bs_status()) == extract.redemption_status(status)
+    assert bs_rewards() == extract.unlocked_rewards(rewards)
+
+    cases = [("csrf token", bs_token, lambda: extract.csrf_token(new)),
+             ("offer forms", bs_forms,
+              lambda: extract.redemption_forms(offer)),
+             ("status div", bs_status,
+              lambda: extract.redemption_status(status)),
+             ("rewards", bs_rewards,
+              lambda: extract.unlocked_rewards(rewards))]
+
+    print("{:12} {:>12} {:>12} {:>8}".format("page", "bs4 [ms]",
+                                             "extract [ms]", "speedup"))
+    # token, forms, status and rewards were parsed once per redemption
+    total_old = total_new = 0
+    for name, old, new_ in cases:
+        t_old = measure(old, args.n)[0] * 1000
+        t_new = measure(new_, args.n)[0] * 1000
+        total_old += t_old
+        total_new += t_new
+        print("{:12} {:12.3f} {:12.3f} {:7.1f}x"
+              .format(name, t_old, t_new, t_old / t_new))
+    print("{:12} {:12.3f} {:12.3f} {:7.1f}x"
+          .format("per code", total_old, total_new, total_old / total_new))
+
+
+def start_fakeshift(*args):
+    """Start fakeshift.py in a subprocess. Returns (process, url)"""
+    import subprocess
+    import sys
+    proc = subprocess.Popen([sys.executable,
+                             path.join(DIRNAME, "fakeshift.py"),
+                             "--port", "0"] + list(args),
+                            stdout=subprocess.PIPE,
+                            universal_newlines=True)
+    return proc, proc.stdout.readline().strip()
+
+
+def bench_redeem(args):
+    """Requests, bytes, wall and CPU time per redeemed code"""
+    import outcomes
+    import store
+    from shift import ShiftClient, Status
+
+    proc, url = start_fakeshift("--latency", str(args.latency),
+                                "--mix", args.mix)
+    try:
+        outcome_cache = outcomes.OutcomeCache(store.KVBackend({}, "outcomes"))
+        client = ShiftClient("bench", "bench", base_url=url,
+                             session_store=store.KVBackend({}, "session"),
+                             outcome_cache=outcome_cache)
+        stats = {"requests": 0, "bytes": 0}
+
+        def count(r, *_, **__):
+            stats["requests"] += 1
+            stats["bytes"] += len(r.content)
+
+        client.client.hooks["response"].append(count)
+
+        codes = ["BENCH-{:05d}-{:05d}".format(args.seed, i)
+                 for i in range(args.n)]
+        statuses = []
+        t_cpu, t_wall = process_time(), perf_counter()
+        for code in codes:
+            if args.all:
+                statuses += client.redeem_all(code, args.platforms).values()
+            else:
+                for platform in args.platforms:
+                    statuses.append(client.redeem(code, platform))
+        cpu = process_time() - t_cpu
+        wall = perf_counter() - t_wall
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    n = len(statuses)
+    print("{} redemptions ({} codes x {} platforms{})"
+          .format(n, args.n, len(args.platforms),
+                  ", redeem_all" if args.all else ""))
+    print("outcomes:      {}".format(", ".join(
+        "{} {}".format(statuses.count(s), Status(s))
+        for s in sorted(set(statuses)))))
+    print("requests/code: {:.2f}".format(stats["requests"] / n))
+    print("cached dead:   {}".format(outcome_cache.hits))
+    print("bytes/code:    {:.0f}".format(stats["bytes"] / n))
+    print("wall/code:     {:.1f} ms".format(wall / n * 1000))
+    print("cpu/code:      {:.1f} ms".format(cpu / n * 1000))
+
+
+def orcz_soup(page, game):
+    """Codes of an orcz page with a full BeautifulSoup tree (as before)"""
+    from bs4 import BeautifulSoup as BSoup
+    from query import platforms
+
+    def check(key):
+        ret = None
+        span = key.find("span")
+        if (not span) or (not span.get("style")) or ("black" in span["style"]):
+            ret = key.text.strip()
+            if ret.count("-") != 4:
+                return None
+            if not all(len(el) == 5 for el in ret.split("-")):
+                return None
+        return ret
+
+    ret = []
+    table = BSoup(page.decode("utf8"), "lxml").find("table")
+    for row in table.find_all("tr")[1:]:
+        cols = row.find_all("td")
+        codes = [check(cols[i]) if i < len(cols) else None
+                 for i in range(4, 7)]
+        codes.insert(1, None)
+        for i in range(len(codes)):
+            if codes[i]:
+                the_platform = platforms[i]
+                if platforms[i] in ["steam", "epic"]:
+                    the_platform = "pc"
+                ret.append((cols[1].text.strip(), codes[i], the_platform,
+                            game))
+    return ret
+
+
+def orcz_stream(page, game):
+    """Codes of an orcz page, parsed in chunks as they would arrive"""
+    import query
+    chunks = (page[i:i + query.CHUNK_SIZE]
+              for i in range(0, len(page), query.CHUNK_SIZE))
+    return list(query.orcz_codes(chunks, game, "utf-8"))
+
+
+def peak_rss(variant, name):
+    """Peak memory [KiB] of parsing fixture `name` once with `variant`.
+
+    Measured in a fresh process; most of it is allocated by libxml2, so
+    tracemalloc wouldn't see it."""
+    import subprocess
+    import sys
+    out = subprocess.check_output([sys.executable, __file__, "orcz",
+                                   "--page", name, "--child", variant],
+                                  universal_newlines=True)
+    return int(out)
+
+
+def bench_orcz(args):
+    """Full BeautifulSoup tree (as before) vs. streaming `extract.table_rows`"""
+    import resource
+    import query
+    variants = {"bs4": orcz_soup, "stream": orcz_stream}
+    with open(path.join(FIXTURES, "orcz", args.page), "rb") as f:
+        page = f.read()
+
+    if args.child:
+        # import everything and warm up before taking the baseline
+        variants[args.child](page[:2048], "bl3")
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        variants[args.child](page, "bl3")
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print(after - before)
+        return
+
+    # before we grow ourselves: children start with our peak (linux)
+    rss = {name: peak_rss(name, args.page) for name in variants}
+
+    # sanity check: both ways have to find the same codes
+    codes = orcz_stream(page, "bl3")
+    # (the soup didn't keep expired codes and expiry dates)
+    assert orcz_soup(page, "bl3") == [el[:4] for el in codes
+                                      if el[4] != query.EXPIRED]
+
+    print("{} ({} KiB, {} codes)".format(args.page, len(page) // 1024,
+                                         len(codes)))
+    print("{:8} {:>10} {:>14}".format("", "time [ms]", "peak mem [KiB]"))
+    for name in ("bs4", "stream"):
+        t = measure(lambda: variants[name](page, "bl3"), args.n)[0] * 1000
+        print("{:8} {:10.1f} {:14}".format(name, t, rss[name]))
+
+
+class SlotKey:
+    """`query.Key` as it was before (filled by setattr)"""
+    __slots__ = ("id", "description", "key", "redeemed", "golden_count")
+    def __init__(self, *args, **kwargs): # noqa
+        for el in SlotKey.__slots__:
+            setattr(self, el, None)
+        for i, el in enumerate(args):
+            setattr(self, SlotKey.__slots__[i], el)
+        for k in kwargs:
+            setattr(self, k, kwargs[k])
+
+
+def bench_keys(args):
+    """Key lists (as before) vs. streaming `query.iter_keys`"""
+    import shutil
+    import tempfile
+    import tracemalloc
+    import query
+
+    tmp = tempfile.mkdtemp()
+    query.DIRNAME = tmp
+    try:
+        query.open_db()
+        query.insert_many(("{} Golden Keys".format(i % 3), "BENCH-{:05d}-{:05d}"
+                           .format(i // 100000, i % 100000), "pc", "bl3")
+                          for i in range(args.rows))
+
+        def slot_keys():
+            where, params = query._key_filter("pc", "bl3", False, None)
+            rows = query.db.execute(
+                "SELECT id, description, key, redeemed, golden_count "
+                "FROM keys" + where + " ORDER BY id DESC", params)
+            keys = [SlotKey(*row) for row in rows]
+            golden = [k for k in keys if k.golden_count]
+            return sum(k.golden_count for k in golden)
+
+        def get_keys():
+            keys = query.get_keys("pc", "bl3")
+            return sum(k.golden_count for k in keys)
+
+        def iter_keys():
+            return sum(k.golden_count for k in query.iter_keys("pc", "bl3"))
+
+        cases = [("list (setattr)", slot_keys), ("get_keys", get_keys),
+                 ("iter_keys", iter_keys)]
+        assert len(set(func() for _, func in cases)) == 1
+
+        print("{} keys".format(args.rows))
+        print("{:16} {:>10} {:>14}".format("", "time [ms]", "peak mem [KiB]"))
+        for name, func in cases:
+            t = measure(func, args.n)[1] * 1000
+            tracemalloc.start()
+            func()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print("{:16} {:10.1f} {:14}".format(name, t, peak // 1024))
+    finally:
+        query.close_db()
+        shutil.rmtree(tmp)
+
+
+def bench_plan(args):
+    """Greedy selection (as before) vs. `planner.plan`"""
+    import random
+    import planner
+
+    rng = random.Random(args.seed)
+    # golden keys per code as they show up on orcz
+    weights = [rng.choice([3, 3, 5, 5, 5, 10, 15, 25])
+               for _ in range(args.codes)]
+
+    def greedy():
+        limit, ret = args.limit, []
+        for i, w in enumerate(weights):
+            if w <= limit:
+                limit -= w
+                ret.append(i)
+        return ret
+
+    print("{} candidates, limit {}".format(args.codes, args.limit))
+    print("{:8} {:>10} {:>12}".format("", "time [ms]", "golden keys"))
+    for name, func in (("greedy", greedy),
+                       ("planner", lambda: planner.plan(weights, args.limit))):
+        t = measure(func, args.n)[0] * 1000
+        print("{:8} {:10.2f} {:12}".format(name, t,
+                                           sum(weights[i] for i in func())))
+
+
+class CountingStream:
+    """Write-only stream that only counts what it gets"""
+    def __init__(self):
+        self.size = 0
+
+    def write(self, text):
+        self.size += len(text)
+
+    def flush(self):
+        pass
+
+
+def legacy_handler(stream):
+    """Handler of `common.initLogger` as it was (colours via filter)"""
+    import logging
+    from common import COLORS, DEBUG
+
+    def rec_filter(record):
+        record.module_lineno = ""
+        if record.levelno == DEBUG:
+            record.module_lineno = "\033[1;36m{}:{} - ".format(
+                record.module,
+                record.lineno)
+        record.color = COLORS[record.levelno]
+        record.spaces = " " * (8 - len(record.levelname))
+        return True
+
+    h = logging.StreamHandler(stream)
+    h.setFormatter(
+        logging.Formatter("\r{bcolor}%(asctime)s "
+                          "[\033[1;%(color)sm%(levelname)s\033[0m{bcolor}] "
+                          "\033[0m%(spaces)s"
+                          "%(module_lineno)s"
+                          "\033[0m%(message)s"
+                          .format(bcolor="\033[1;36m")))
+    h.addFilter(rec_filter)
+    return h
+
+
+def bench_logging(args):
+    """Log calls of a redeemed code: eager + colours (as before) vs. lazy
+
+    The calls are the ones `auto.redeem` and `ShiftClient.redeem` make
+    for a code that is redeemed (lookup, POST, redirect, 2 status polls)."""
+    import logging
+    from collections import namedtuple
+    from common import (ColorFormatter, JsonFormatter, LogfmtFormatter,
+                        DEBUG, INFO)
+
+    Request = namedtuple("Request", ("method", ))
+    Reply = namedtuple("Reply", ("request", "url", "status_code"))
+    base_url = "https://shift.gearboxsoftware.com"
+    code = "WTKBJ-RZWJR-XTT9B-JB3JB-ZSKHK"
+    lookup = Reply(Request("GET"), "{}/entitlement_offer_codes?code={}"
+                   .format(base_url, code), 200)
+    post = Reply(Request("POST"), "{}/code_redemptions".format(base_url), 302)
+    status_url = "code_redemptions/0c3e2f0c-5a47-4a8d-9e3c-9c29f6c2a7e4"
+
+    def eager(log):
+        log.info("Trying to redeem {} ({}) for {}"
+                 .format("5 Golden Keys", code, "epic"))
+        r = lookup
+        log.debug("{} {} {}".format(r.request.method, r.url, r.status_code))
+        r = post
+        log.debug("{} {} {}".format(r.request.method, r.url, r.status_code))
+        log.info("Your code is being redeemed")
+        for _ in range(2):
+            log.debug("get " + "{}/{}".format(base_url, status_url))
+        log.debug("{}: {}".format("SUCCESS", "Your code was redeemed"))
+        log.debug("Status: {}".format("SUCCESS"))
+        log.info("Redeemed {}".format("5 Golden Keys"))
+
+    def lazy(log):
+        log.info("Trying to redeem {} ({}) for {}"
+                 .format("5 Golden Keys", code, "epic"))
+        r = lookup
+        log.debug("%s %s %s", r.request.method, r.url, r.status_code)
+        r = post
+        log.debug("%s %s %s", r.request.method, r.url, r.status_code)
+        log.info("Your code is being redeemed")
+        for _ in range(2):
+            log.debug("get %s/%s", base_url, status_url)
+        log.debug("%s: %s", "SUCCESS", "Your code was redeemed")
+        log.debug("Status: %s", "SUCCESS")
+        log.info("Redeemed {}".format("5 Golden Keys"))
+
+    def formatter_handler(cls):
+        def make(stream):
+            h = logging.StreamHandler(stream)
+            h.setFormatter(cls())
+            return h
+        return make
+
+    cases = [("eager, color (old)", eager, legacy_handler),
+             ("lazy, color", lazy, formatter_handler(ColorFormatter)),
+             ("lazy, logfmt", lazy, formatter_handler(LogfmtFormatter)),
+             ("lazy, json", lazy, formatter_handler(JsonFormatter))]
+
+    print("{} codes".format(args.n))
+    print("{:6} {:20} {:>10} {:>14}".format("level", "", "cpu [us]",
+                                            "bytes / code"))
+    for level in (INFO, DEBUG):
+        for name, calls, make_handler in cases:
+            stream = CountingStream()
+            log = logging.getLogger("autoshift.bench.{}".format(name))
+            log.propagate = False
+            log.handlers = [make_handler(stream)]
+            log.setLevel(level)
+            t = measure(lambda: calls(log), args.n)[0] * 1e6
+            print("{:6} {:20} {:10.1f} {:14.0f}"
+                  .format(logging.getLevelName(level), name, t,
+                          stream.size / args.n))
+
+
+def setup_argparser():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="bench")
+    sub.required = True
+
+    p = sub.add_parser("extract", help="html extraction of SHiFT pages")
+    p.add_argument("-n", type=int, default=200, help="iterations")
+    p.set_defaults(func=bench_extract)
+
+    p = sub.add_parser("redeem", help="ShiftClient.redeem against fakeshift")
+    p.add_argument("-n", type=int, default=50, help="number of codes")
+    p.add_argument("--platforms", nargs="+", default=["epic"],
+                   help="platforms to redeem each code for")
+    p.add_argument("--all", action="store_true",
+                   help="use ShiftClient.redeem_all")
+    p.add_argument("--latency", type=float, default=0.01,
+                   help="latency of fakeshift per request in seconds")
+    p.add_argument("--mix", default="success=8,redeemed=1,expired=1,invalid=1",
+                   help="outcome mix of fakeshift")
+    p.add_argument("--seed", type=int, default=0,
+                   help="different seeds give different codes")
+    p.set_defaults(func=bench_redeem)
+
+    p = sub.add_parser("orcz", help="parsing the code table of orcz pages")
+    p.add_argument("-n", type=int, default=10, help="iterations")
+    p.add_argument("--page", default="bl3.html",
+                   help="page in fixtures/orcz")
+    p.add_argument("--child", choices=["bs4", "stream"],
+                   help=argparse.SUPPRESS)
+    p.set_defaults(func=bench_orcz)
+
+    p = sub.add_parser("keys", help="reading keys from the database")
+    p.add_argument("-n", type=int, default=5, help="iterations")
+    p.add_argument("--rows", type=int, default=100000,
+                   help="number of keys in the database")
+    p.set_defaults(func=bench_keys)
+
+    p = sub.add_parser("plan", help="picking golden keys under --limit")
+    p.add_argument("-n", type=int, default=20, help="iterations")
+    p.add_argument("--codes", type=int, default=5000,
+                   help="number of candidate redemptions")
+    p.add_argument("--limit", type=int, default=199, help="--limit")
+    p.add_argument("--seed", type=int, default=0)
+    p.set_defaults(func=bench_plan)
+
+    p = sub.add_parser("logging", help="log calls of one redeemed code")
+    p.add_argument("-n", type=int, default=20000, help="number of codes")
+    p.set_defaults(func=bench_logging)
+
+    return parser
+
+
+if __name__ == "__main__":
+    args = setup_argparser().parse_args()
+    args.func(args)
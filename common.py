@@ -19,51 +19,127 @@
 # along with autoshift.  If not, see <http://www.gnu.org/licenses/>.
 #
 #############################################################################
+import json
 import logging
+import os
+import re
+import time
 from logging import NOTSET, DEBUG, INFO, WARNING, ERROR, CRITICAL
 from os import path
 
 FILEPATH = path.realpath(__file__)
 DIRNAME = path.dirname(FILEPATH)
 
+# environment variable to choose the log format (see `LOG_FORMATS`)
+LOG_FORMAT_ENV = "AUTOSHIFT_LOG_FORMAT"
+# auto: color on a terminal, logfmt otherwise
+LOG_FORMATS = ("auto", "color", "json", "logfmt")
 
-def initLogger():
+COLORS = {
+    NOTSET: 36,
+    DEBUG: 33,
+    INFO: 34,
+    WARNING: .35,
+    ERROR: 31,
+    CRITICAL: "5;31"
+}
+BCOLOR = "\033[1;36m"
 
-    colors = {
-        NOTSET: 36,
-        DEBUG: 33,
-        INFO: 34,
-        WARNING: .35,
-        ERROR: 31,
-        CRITICAL: "5;31"
-    }
-    logger = None
 
-    logger = logging.getLogger("autoshift")
-
-    def rec_filter(record):
-        record.module_lineno = ""
+class ColorFormatter(logging.Formatter):
+    """Coloured lines for terminals"""
+    def formatMessage(self, record):
+        location = ""
         if record.levelno == DEBUG:
-            record.module_lineno = "\033[1;36m{}:{} - ".format(
-                record.module,
-                record.lineno)
-        record.color = colors[record.levelno]
-        record.spaces = " " * (8 - len(record.levelname))
-        return True
+            location = "{}{}:{} - ".format(BCOLOR, record.module,
+                                           record.lineno)
+        return ("\r{bcolor}{time} [\033[1;{color}m{level}\033[0m{bcolor}] "
+                "\033[0m{spaces}{location}\033[0m{message}"
+                .format(bcolor=BCOLOR,
+                        time=self.formatTime(record),
+                        color=COLORS.get(record.levelno, COLORS[NOTSET]),
+                        level=record.levelname,
+                        spaces=" " * (8 - len(record.levelname)),
+                        location=location,
+                        message=record.message))
+
+
+# (second, formatted) of the last structured log line
+__second = (None, None)
+
+
+def _isotime(created):
+    """Local ISO 8601 time with milliseconds"""
+    global __second
+    second = int(created)
+    if __second[0] != second:
+        __second = (second, time.strftime("%Y-%m-%dT%H:%M:%S",
+                                          time.localtime(second)))
+    return "{}.{:03d}".format(__second[1], int((created - second) * 1000))
+
+
+def _fields(formatter, record):
+    """Fields of a structured log line"""
+    ret = {"time": _isotime(record.created),
+           "level": record.levelname.lower(),
+           "module": record.module}
+    if record.levelno == DEBUG:
+        ret["line"] = record.lineno
+    ret["msg"] = record.getMessage()
+    if record.exc_info:
+        ret["exc"] = formatter.formatException(record.exc_info)
+    return ret
 
-    h = logging.StreamHandler()
-    h.setFormatter(
-        logging.Formatter("\r{bcolor}%(asctime)s "
-                          "[\033[1;%(color)sm%(levelname)s\033[0m{bcolor}] "
-                          "\033[0m%(spaces)s"
-                          "%(module_lineno)s"
 
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+    def format(self, record):
+        return json.dumps(_fields(self, record))
 
-                          "\033[0m%(message)s"
-                          .format(bcolor="\033[1;36m")))
-    h.addFilter(rec_filter)
+
+class LogfmtFormatter(logging.Formatter):
+    """key=value pairs (https://brandur.org/logfmt)"""
+    needs_quotes = re.compile(r'[\s="\\]|^$').search
+
+    def value(self, v):
+        v = str(v)
+        return json.dumps(v) if self.needs_quotes(v) else v
+
+    def format(self, record):
+        fields = _fields(self, record)
+        # time, level, module and line never need quotes
+        msg = fields.pop("msg")
+        exc = fields.pop("exc", None)
+        ret = " ".join("{}={}".format(k, v) for k, v in fields.items())
+        ret += " msg=" + self.value(msg)
+        if exc:
+            ret += " exc=" + self.value(exc)
+        return ret
+
+
+def initLogger(fmt=None):
+    """Set up the `autoshift` logger
+
+    `fmt` is one of `LOG_FORMATS`. Defaults to $AUTOSHIFT_LOG_FORMAT or
+    auto."""
+    logger = logging.getLogger("autoshift")
+
+    fmt = (fmt or os.environ.get(LOG_FORMAT_ENV) or "auto").lower()
+    unknown = None
+    if fmt not in LOG_FORMATS:
+        unknown, fmt = fmt, "auto"
+    h = logging.StreamHandler()
+    if fmt == "auto":
+        isatty = getattr(h.stream, "isatty", None)
+        fmt = "color" if isatty and isatty() else "logfmt"
+    h.setFormatter({"color": ColorFormatter,
+                    "json": JsonFormatter,
+                    "logfmt": LogfmtFormatter}[fmt]())
     logger.handlers = []
     logger.addHandler(h)
+    if unknown:
+        logger.warning("Unknown log format `{}` (one of {})"
+                       .format(unknown, ", ".join(LOG_FORMATS)))
     return logger
 
 
@@ -0,0 +1,247 @@
+#############################################################################
+#
+# Copyright (C) 2018 Fabian Schweinfurth
+# Contact: autoshift <at> derfabbi.de
+#
+# This file is part of autoshift
+#
+# autoshift is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autoshift is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with autoshift.  If not, see <http://www.gnu.org/licenses/>.
+#
+#############################################################################
+"""Long running mode of `auto.py` (`--daemon`).
+
+Unlike `--schedule` the client (with its HTTP connections and CSRF
+token), the HTTP pool for the code sources and the database stay open
+for the whole life of the process.
+
+- SIGHUP reloads the `--config` file (used from the next run on)
+- SIGTERM/SIGINT stop after the code that is currently redeemed
+- `--status-port` serves the state as JSON (`/status`, `/health`)
+- `--metrics-json`/`--metrics-prom` files are written after each run
+"""
+import json
+import os
+import signal
+import threading
+from datetime import datetime
+from time import time
+
+import auto
+import metrics
+import query
+from common import _L
+
+# settings a config file may change
+CONFIG_KEYS = ("games", "platforms", "golden", "non_golden", "limit",
+               "concurrency", "rewards", "interval", "fetch_interval",
+               "refresh")
+# failed runs in a row until /health reports unhealthy
+MAX_ERRORS = 3
+
+
+def _isotime(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp).isoformat()
+
+
+class Daemon:
+    def __init__(self, args):
+        self.args = args
+        self.stopping = threading.Event()
+        # set to wake up the main loop (reload or stop)
+        self.wakeup = threading.Event()
+        self.reload_requested = False
+        self.state = "starting"
+        self.started_at = time()
+        self.runs = 0
+        self.errors = 0
+        self.last_run = None
+        # `metrics.summary` and new keys per game of the last run
+        # (copies, the status is served from another thread)
+        self.last_metrics = None
+        self.new_keys = {}
+        self.next_run = None
+        self.httpd = None
+
+    def load_config(self):
+        """Apply settings of the `--config` file to our args"""
+        if not self.args.config:
+            return
+        try:
+            with open(self.args.config) as f:
+                config = json.load(f)
+        except (IOError, ValueError) as e:
+            _L.error("Could not load config {}: {}"
+                     .format(self.args.config, e))
+            return
+
+        for k, v in config.items():
+            k = k.replace("-", "_")
+            if k not in CONFIG_KEYS:
+                _L.warning("Ignoring unknown setting `{}` in {}"
+                           .format(k, self.args.config))
+                continue
+            setattr(self.args, k, v)
+        self.apply_config()
+        _L.info("Loaded config {}".format(self.args.config))
+
+    def apply_config(self):
+        """Update what `auto` set up with settings that changed"""
+        if auto.client is not None:
+            auto.client.track_rewards = self.args.rewards
+        aclient = auto.aclient
+        if (aclient is not None
+                and aclient.concurrency != max(1, self.args.concurrency)):
+            # built with the new concurrency on next use
+            auto.aclient = None
+            aclient.close()
+
+    def handle_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            _L.info("Reloading config before the next run")
+            self.reload_requested = True
+            self.wakeup.set()
+            return
+        if not self.stopping.is_set():
+            _L.info("Shutting down ...")
+        self.stopping.set()
+        self.wakeup.set()
+
+    def status(self):
+        """State of the daemon as dict"""
+        ratelimit = auto.ratelimit
+        client = auto.client
+        ret = {
+            "state": self.state,
+            "pid": os.getpid(),
+            "started_at": _isotime(self.started_at),
+            "runs": self.runs,
+            "errors": self.errors,
+            "last_run": self.last_run,
+            "next_run": _isotime(self.next_run),
+            "rate_limited": bool(ratelimit and ratelimit.limited()),
+            "resume_at": _isotime(ratelimit.resume_at if ratelimit else None),
+            "limit_left": self.args.limit,
+            "config": {k: getattr(self.args, k, None) for k in CONFIG_KEYS},
+            "sources": dict(query.fetch_stats),
+            "new_keys": self.new_keys,
+            "metrics": self.last_metrics,
+        }
+        if client is not None:
+            ret["token_fetches"] = client.token_fetches
+            ret["token_fetches_saved"] = client.token_fetches_saved
+            ret["dead_code_lookups_saved"] = client.outcome_cache.hits
+        return ret
+
+    def healthy(self):
+        return not self.stopping.is_set() and self.errors < MAX_ERRORS
+
+    def serve_status(self, port):
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+
+        daemon = self
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self): # noqa
+                route = self.path.split("?")[0].rstrip("/")
+                if route == "/health":
+                    code = 200 if daemon.healthy() else 503
+                    body = {"ok": code == 200, "state": daemon.state}
+                elif route in ("", "/status"):
+                    code, body = 200, daemon.status()
+                else:
+                    code, body = 404, {"error": "not found"}
+                data = json.dumps(body).encode("utf8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.httpd = Server(("", port), Handler)
+        t = threading.Thread(target=self.httpd.serve_forever)
+        t.daemon = True
+        t.start()
+        _L.info("Serving status on port {}".format(self.httpd.server_port))
+
+    def tick(self):
+        """One run of `auto.run`"""
+        fetch_only = auto.ratelimit.limited()
+        self.state = "running"
+        start = time()
+        run = {"started_at": _isotime(start), "fetch_only": fetch_only}
+        try:
+            auto.run(self.args, fetch_only, stop=self.stopping)
+            self.errors = 0
+        except Exception as e:
+            self.errors += 1
+            run["error"] = str(e)
+            _L.exception("Run failed: {}".format(e))
+        finally:
+            self.runs += 1
+            run["duration"] = round(time() - start, 3)
+            self.last_run = run
+            self.new_keys = {game: new
+                             for game, (new, _) in list(query.parsed.items())}
+            # the first run includes the login
+            auto.export_metrics(self.args)
+            self.last_metrics = metrics.summary()
+            metrics.reset()
+            self.state = "idle"
+
+    def run(self):
+        """Run until we get SIGTERM or SIGINT"""
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, self.handle_signal)
+
+        self.load_config()
+        metrics.reset()
+        if self.args.status_port is not None:
+            self.serve_status(self.args.status_port)
+
+        auto.setup(self.args)
+        query.open_db()
+        try:
+            while not self.stopping.is_set():
+                self.tick()
+                if self.stopping.is_set():
+                    break
+
+                self.next_run = auto.ratelimit.next_run(
+                    interval=self.args.interval * 60,
+                    fetch_interval=self.args.fetch_interval * 60)
+                _L.info("Next run at {}".format(datetime.fromtimestamp(
+                    self.next_run).strftime("%H:%M:%S")))
+                # sleep until then. signals wake us up early
+                while not self.stopping.is_set() and time() < self.next_run:
+                    self.wakeup.wait(self.next_run - time())
+                    self.wakeup.clear()
+                    if self.reload_requested:
+                        self.reload_requested = False
+                        self.load_config()
+        finally:
+            self.state = "stopped"
+            query.close_db()
+            if self.httpd is not None:
+                self.httpd.shutdown()
+                self.httpd.server_close()
+            _L.info("Stopped")
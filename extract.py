@@ -0,0 +1,143 @@
+#############################################################################
+#
+# Copyright (C) 2018 Fabian Schweinfurth
+# Contact: autoshift <at> derfabbi.de
+#
+# This file is part of autoshift
+#
+# autoshift is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autoshift is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with autoshift.  If not, see <http://www.gnu.org/licenses/>.
+#
+#############################################################################
+"""Targeted extraction of the few elements we need from SHiFT pages.
+
+Building a full BeautifulSoup tree for every reply is by far the most
+expensive part of a redemption (CPU-wise). These helpers let lxml parse
+as little of the document as possible and only look at the elements
+they need.
+
+`table_rows` does the same for the (large) pages of code sources. It
+parses a page while it is downloaded and stops after the first table.
+"""
+from lxml import etree
+from lxml import html as lhtml
+
+
+def _has_class(cls):
+    return ("contains(concat(' ', normalize-space(@class), ' '), ' {} ')"
+            .format(cls))
+
+
+__meta_token = etree.XPath("//meta[@name='csrf-token']/@content")
+__forms = etree.XPath("//form[{}]".format(_has_class("new_archway_code_redemption")))
+__form_input = etree.XPath(".//input[@name=$name or @id=$name]/@value")
+__status_div = etree.XPath("//div[@id='check_redemption_status']")
+__rewards = etree.XPath("//div[{}]".format(_has_class("reward_unlocked")))
+
+
+def _parse(text):
+    """Parse (partial) html. Returns None for empty documents"""
+    if not text or not text.strip():
+        return None
+    try:
+        return lhtml.fromstring(text)
+    except (etree.ParserError, ValueError):
+        return None
+
+
+def csrf_token(text):
+    """Get content of the `csrf-token` meta tag (or None)"""
+    # the token lives in <head>. don't bother parsing the body
+    end = text.find("</head>")
+    if end >= 0:
+        text = text[:end] + "</head></html>"
+    tree = _parse(text)
+    if tree is None:
+        return None
+    token = __meta_token(tree)
+    return token[0] if token else None
+
+
+def redemption_forms(text):
+    """Get all code redemption forms
+
+    Returns a list of dicts (one per service) with the keys
+    `authenticity_token`, `code`, `check` and `service`"""
+    tree = _parse(text)
+    if tree is None:
+        return []
+
+    def value(form, name):
+        ret = __form_input(form, name=name)
+        return ret[0] if ret else None
+
+    return [{"authenticity_token": value(form, "authenticity_token"),
+             "code": value(form, "archway_code_redemption_code"),
+             "check": value(form, "archway_code_redemption_check"),
+             "service": value(form, "archway_code_redemption_service")}
+            for form in __forms(tree)]
+
+
+def redemption_status(text):
+    """Get [text, data-url, data-fallback-url] of the status div"""
+    ret = [None, None, None]
+    tree = _parse(text)
+    if tree is None:
+        return ret
+    div = __status_div(tree)
+    if div:
+        div = div[0]
+        ret[0] = div.text_content().strip()
+        ret[1] = div.get("data-url")
+        ret[2] = div.get("data-fallback-url")
+    return ret
+
+
+def unlocked_rewards(text):
+    """Get texts of all unlocked rewards"""
+    tree = _parse(text)
+    if tree is None:
+        return []
+    return [el.text_content() for el in __rewards(tree)]
+
+
+def table_rows(chunks, encoding=None):
+    """Yield the cells (`td` elements) of each row of the first table
+
+    `chunks` is an iterable of (bytes) pieces of the page. Parsing stops
+    as soon as the first table is closed; rows are freed after they
+    were handed out."""
+    parser = etree.HTMLPullParser(events=("start", "end"), encoding=encoding)
+    # hand out lxml.html elements (`text_content()` etc.)
+    parser.set_element_class_lookup(lhtml.HtmlElementClassLookup())
+    depth = 0
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event, el in parser.read_events():
+            if el.tag != "table" and not depth:
+                continue
+            if event == "start":
+                if el.tag == "table":
+                    depth += 1
+                continue
+
+            if el.tag == "table":
+                depth -= 1
+                if not depth:
+                    return
+            elif el.tag == "tr" and depth == 1:
+                yield [td for td in el if td.tag == "td"]
+                # drop handled rows
+                el.clear()
+                while el.getprevious() is not None:
+                    del el.getparent()[0]
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+#############################################################################
+#
+# Copyright (C) 2018 Fabian Schweinfurth
+# Contact: autoshift <at> derfabbi.de
+#
+# This file is part of autoshift
+#
+# autoshift is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autoshift is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with autoshift.  If not, see <http://www.gnu.org/licenses/>.
+#
+#############################################################################
+"""Local stand-in for shift.gearboxsoftware.com.
+
+Serves the routes `ShiftClient` uses with pages built from the saved
+fixtures. Each request can be delayed by `latency` seconds and the
+outcome of a code is drawn from `mix` (seeded with the code, so the same
+code always has the same outcome). Codes starting with one of the
+outcome names in upper case (e.g. `EXPIRED-...`) always have that outcome.
+
+    ./fakeshift.py --port 8000 --latency 0.05 --mix success=8,expired=1
+
+    client = ShiftClient(user="a", pw="b", base_url="http://127.0.0.1:8000")
+"""
+from __future__ import print_function
+import json
+import random
+import threading
+from time import sleep
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+from bench import fixture
+
+OUTCOMES = ["success", "redeemed", "expired", "invalid", "trylater"]
+MIX = {"success": 1}
+
+SESSION_COOKIE = "si"
+
+
+class FakeShift(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0, mix=None, polls=2):
+        """`polls`: number of status polls until a redemption is done"""
+        HTTPServer.__init__(self, ("127.0.0.1", port), Handler)
+        self.latency = latency
+        self.mix = mix or MIX
+        self.polls = polls
+        self.lock = threading.Lock()
+        self.requests = 0
+        # number of the next redemptions to reject (like a stale token)
+        self.reject = 0
+        self.redemptions = {}
+        self.unlocked = []
+
+        self.pages = {
+            "new": fixture("shift", "code_redemptions_new.html"),
+            "offer": fixture("shift", "entitlement_offer_codes.html"),
+            "status": fixture("shift", "code_redemption_status.html"),
+            "rewards": fixture("shift", "rewards.html"),
+        }
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server_port)
+
+    def outcome(self, code):
+        """Outcome of a code"""
+        for el in OUTCOMES:
+            if code.startswith(el.upper()):
+                return el
+        rng = random.Random(code)
+        names = sorted(self.mix)
+        return rng.choices(names, [self.mix[el] for el in names])[0]
+
+    def start(self):
+        """Serve in background thread"""
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body="", content_type="text/html",
+              headers=None):
+        data = body.encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type",
+                         "{}; charset=utf-8".format(content_type))
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def redirect(self, location, headers=None):
+        headers = dict(headers or {}, Location=location)
+        self.reply(302, headers=headers)
+
+    def logged_in(self):
+        cookie = self.headers.get("Cookie") or ""
+        return "{}=".format(SESSION_COOKIE) in cookie
+
+    def begin(self):
+        srv = self.server
+        with srv.lock:
+            srv.requests += 1
+        if srv.latency:
+            sleep(srv.latency)
+        return urlparse(self.path)
+
+    def do_GET(self): # noqa
+        url = self.begin()
+        srv = self.server
+        route = url.path.rstrip("/")
+
+        if route == "/home":
+            return self.reply(200, srv.pages["new"])
+
+        if not self.logged_in():
+            return self.redirect("/home")
+
+        if route in ("/account", "/code_redemptions/new"):
+            return self.reply(200, srv.pages["new"])
+
+        if route == "/entitlement_offer_codes":
+            code = parse_qs(url.query).get("code", [""])[0]
+            outcome = srv.outcome(code)
+            if outcome == "invalid":
+                return self.reply(500, "Internal Server Error")
+            if outcome == "expired":
+                return self.reply(200, "This SHiFT code has expired")
+            page = srv.pages["offer"].replace("WTKBJ-RZWJR-XTT9B-JB3JB-ZSKHK",
+                                              code)
+            return self.reply(200, page)
+
+        if route == "/rewards":
+            rewards = "".join('<div class="reward reward_unlocked">{}</div>'
+                              .format(el) for el in srv.unlocked)
+            return self.reply(200, srv.pages["rewards"].replace(
+                '<div class="rewards_list">',
+                '<div class="rewards_list">' + rewards))
+
+        if route.startswith("/code_redemptions/"):
+            parts = route.split("/")
+            rid = parts[2]
+            with srv.lock:
+                redemption = srv.redemptions.get(rid)
+            if redemption is None:
+                return self.reply(404, "Not Found")
+
+            if len(parts) == 4 and parts[3] == "status":
+                with srv.lock:
+                    redemption["polls"] += 1
+                    done = redemption["polls"] >= srv.polls
+                if not done:
+                    return self.reply(200, json.dumps({"in_progress": True}),
+                                      "application/json")
+                if redemption["outcome"] == "redeemed":
+                    text = "Failed to redeem your SHiFT code"
+                else:
+                    text = "Your code was successfully redeemed"
+                return self.reply(200, json.dumps({"text": text}),
+                                  "application/json")
+
+            page = srv.pages["status"].replace(
+                "code_redemptions/0c3e2f0c-5a47-4a8d-9e3c-9c29f6c2a7e4",
+                "code_redemptions/{}".format(rid))
+            return self.reply(200, page)
+
+        return self.reply(404, "Not Found")
+
+    def do_POST(self): # noqa
+        url = self.begin()
+        srv = self.server
+        length = int(self.headers.get("Content-Length") or 0)
+        data = parse_qs(self.rfile.read(length).decode("utf8"))
+
+        if url.path == "/sessions":
+            return self.redirect("/account", {
+                "Set-Cookie": "{}=fakeshift; Path=/".format(SESSION_COOKIE)})
+
+        if not self.logged_in():
+            return self.redirect("/home")
+
+        if url.path == "/code_redemptions":
+            with srv.lock:
+                reject, srv.reject = srv.reject > 0, max(0, srv.reject - 1)
+            if reject:
+                return self.reply(422, "Unprocessable Entity")
+            code = data.get("archway_code_redemption[code]", [""])[0]
+            service = data.get("archway_code_redemption[service]", [""])[0]
+            outcome = srv.outcome(code)
+            if outcome == "trylater":
+                # no status div. That's what SHiFT does when you hit the limit
+                return self.reply(200, srv.pages["new"])
+            with srv.lock:
+                rid = "{:08x}".format(len(srv.redemptions))
+                srv.redemptions[rid] = {"outcome": outcome, "polls": 0}
+                if outcome == "success":
+                    srv.unlocked.append("{} ({})".format(code, service))
+            return self.redirect("{}/code_redemptions/{}".format(srv.url, rid))
+
+        return self.reply(404, "Not Found")
+
+
+def parse_mix(text):
+    """'success=8,expired=1' -> {'success': 8.0, 'expired': 1.0}"""
+    ret = {}
+    for el in text.split(","):
+        name, _, weight = el.partition("=")
+        if name not in OUTCOMES:
+            raise ValueError("unknown outcome `{}`".format(name))
+        ret[name] = float(weight or 1)
+    return ret
+
+
+def setup_argparser():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8000,
+                        help="port to listen on (0: pick a free one)")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="seconds to delay each request")
+    parser.add_argument("--polls", type=int, default=2,
+                        help="status polls until a redemption is done")
+    parser.add_argument("--mix", type=parse_mix, default=MIX,
+                        help=("outcome weights, e.g. success=8,expired=1 "
+                              "(outcomes: {})".format(", ".join(OUTCOMES))))
+    return parser
+
+
+if __name__ == "__main__":
+    import sys
+    args = setup_argparser().parse_args()
+    srv = FakeShift(args.port, args.latency, args.mix, args.polls)
+    # let callers (e.g. bench.py) know which port we got
+    print(srv.url)
+    sys.stdout.flush()
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
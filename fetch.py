@@ -104,9 +104,10 @@ def map_expirations(filtered_tweets):
             expire_float = re.sub(r'~', '', split_expires[0])
             expire_interval = split_expires[1]
 
-        if expire_interval == "HOURS":
+        # the regex ignores case ("48 Hours", "3 DAYS", ...)
+        if expire_interval.lower() == "hours":
             t["expire_time"] = str(starttime + timedelta(hours=float(expire_float)))
-        elif expire_interval == "DAYS" or expire_interval == "Days":
+        else:
             t["expire_time"] = str(starttime + timedelta(days=float(expire_float)))
         tweets.append(t)
     return tweets
@@ -120,6 +121,7 @@ class ShiftCode(Model):
       tweetMsg      : (string), the raw message in the tweet
       expiresTime   : (number) in form of epoch timestamp
       redeemed      : (bool) true if code is already remdeemed, false if not
+      expired       : (bool) true if code expired before it could be redeemed
       redeemRetry   : (number) number of times redemption has been attempted without success
       published     : (bool) true if code has been published to slack/discord
       publishRetry  : (number) counter for how many publish attempts have been made without success
@@ -133,23 +135,29 @@ class ShiftCode(Model):
     tweetMsg = UnicodeAttribute(null=True)
     expiresTime = NumberAttribute(null=True)
     redeemed = BooleanAttribute(default=False)
+    expired = BooleanAttribute(default=False)
     redeemRetry = NumberAttribute(default=0)
     published = BooleanAttribute(default=False)
     publishRetry = NumberAttribute(default=0)
 
 
+def expire_timestamp(tweet_dict):
+    """epoch timestamp of the `expire_time` of a parsed tweet (or None)"""
+    if tweet_dict.get("expire_time") is None:
+        return None
+    # `utctimetuple` for times with an offset. naive times are UTC already
+    return calendar.timegm(parse(tweet_dict["expire_time"]).utctimetuple())
+
+
 def write_dynamo_item(tweet_dict):
     tweet_timestamp = calendar.timegm(parse(tweet_dict["tweet_created"]).timetuple())
-    if tweet_dict["expire_time"] is None:
-        expire_timestamp = None
-    else:
-        expire_timestamp = calendar.timegm(parse(tweet_dict["expire_time"]).timetuple())
+    expire_ts = expire_timestamp(tweet_dict)
 
     shift_entry = ShiftCode(
         tweet_dict["code"],
         tweet_timestamp,
         tweetMsg=tweet_dict["msg"],
-        expiresTime=expire_timestamp,
+        expiresTime=expire_ts,
         redeemed=tweet_dict["redeemed"],
         redeemRetry=tweet_dict["redemption_retries"],
         published=tweet_dict["published"],
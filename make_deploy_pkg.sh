@@ -2,7 +2,33 @@
 
 set -x
 epochts="$(date -u +%s)"
-zip -u ./awslambda/bin/autoshift_${epochts}.zip fetch.py redeem.py shift.py common.py
+modules="fetch.py redeem.py shift.py common.py extract.py store.py transport.py outcomes.py metrics.py"
+
+# every local module the handlers import has to be in the package.
+# a missing one only shows up as ImportError in the Lambda
+missing="$(python3 - $modules <<'PY'
+import os
+import sys
+from modulefinder import ModuleFinder
+
+here = os.getcwd()
+needed = set()
+for handler in ("redeem.py", "fetch.py"):
+    finder = ModuleFinder(path=[here])
+    finder.run_script(handler)
+    needed.update(os.path.basename(m.__file__)
+                  for m in finder.modules.values()
+                  if m.__file__ and os.path.dirname(
+                      os.path.abspath(m.__file__)) == here)
+print(" ".join(sorted(needed - set(sys.argv[1:]))))
+PY
+)"
+if [ -n "$missing" ]; then
+  echo "modules missing in the package: $missing" >&2
+  exit 1
+fi
+
+zip -u ./awslambda/bin/autoshift_${epochts}.zip $modules
 
 venv_python="$(find .venv/lib -maxdepth 1 -name "python*" | cut -d"/" -f3)"
 pushd $VIRTUAL_ENV/lib/$venv_python/site-packages
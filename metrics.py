@@ -0,0 +1,174 @@
+#############################################################################
+#
+# Copyright (C) 2018 Fabian Schweinfurth
+# Contact: autoshift <at> derfabbi.de
+#
+# This file is part of autoshift
+#
+# autoshift is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autoshift is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with autoshift.  If not, see <http://www.gnu.org/licenses/>.
+#
+#############################################################################
+"""Timers and counters of a run.
+
+Stages are timed with `timer` (or the `timed` decorator) and events are
+counted with `count`. Everything is kept in this module (for all
+threads) until `reset` is called, which `auto.py` does at the start of
+each run.
+
+    with metrics.timer("query.fetch"):
+        r = session.get(url)
+    metrics.count("http.requests")
+
+The collected values can be written as a JSON run summary
+(`write_json`) or as a Prometheus textfile (`write_prometheus`, for the
+textfile collector of the node exporter).
+"""
+import json
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter, time
+
+PROM_PREFIX = "autoshift"
+
+__lock = threading.Lock()
+# name -> [calls, total seconds, max seconds]
+timers = {}
+# name -> number
+counters = {}
+started = time()
+
+
+def reset():
+    """Forget everything collected so far"""
+    global started
+    with __lock:
+        timers.clear()
+        counters.clear()
+        started = time()
+
+
+def observe(name, seconds):
+    """Add one call of `seconds` to timer `name`"""
+    with __lock:
+        t = timers.setdefault(name, [0, 0.0, 0.0])
+        t[0] += 1
+        t[1] += seconds
+        t[2] = max(t[2], seconds)
+
+
+def count(name, n=1):
+    """Increment counter `name` by `n`"""
+    with __lock:
+        counters[name] = counters.get(name, 0) + n
+
+
+@contextmanager
+def timer(name):
+    """Time the body of a `with` statement"""
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, perf_counter() - start)
+
+
+def timed(name):
+    """Decorator to time each call of a function"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def summary():
+    """Collected values as dict"""
+    with __lock:
+        stages = {name: {"calls": calls,
+                         "total": round(total, 6),
+                         "avg": round(total / calls, 6),
+                         "max": round(longest, 6)}
+                  for name, (calls, total, longest) in timers.items()}
+        ret = {"started": started,
+               "duration": round(time() - started, 6),
+               "stages": stages,
+               "counters": dict(counters)}
+
+    # the number we care about the most
+    codes = ret["counters"].get("shift.codes")
+    if codes:
+        ret["requests_per_code"] = round(
+            ret["counters"].get("shift.requests", 0) / codes, 3)
+    return ret
+
+
+def to_json():
+    return json.dumps(summary(), indent=2, sort_keys=True)
+
+
+def _label(value):
+    return (str(value).replace("\\", "\\\\").replace("\"", "\\\"")
+            .replace("\n", "\\n"))
+
+
+def to_prometheus(prefix=PROM_PREFIX):
+    """Collected values in Prometheus text format
+
+    All values describe the last run, so they are exported as gauges."""
+    s = summary()
+    lines = []
+
+    def metric(name, help_text, samples):
+        name = "{}_{}".format(prefix, name)
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} gauge".format(name))
+        for labels, value in samples:
+            if labels:
+                labels = "{{{}}}".format(",".join(
+                    "{}=\"{}\"".format(k, _label(v))
+                    for k, v in sorted(labels.items())))
+            lines.append("{}{} {}".format(name, labels or "", value))
+
+    stages = sorted(s["stages"].items())
+    metric("run_started_timestamp_seconds", "Start of the last run",
+           [(None, s["started"])])
+    metric("run_duration_seconds", "Duration of the last run",
+           [(None, s["duration"])])
+    metric("stage_calls", "Calls of a stage in the last run",
+           [({"stage": k}, v["calls"]) for k, v in stages])
+    metric("stage_seconds", "Total time spent in a stage in the last run",
+           [({"stage": k}, v["total"]) for k, v in stages])
+    metric("stage_max_seconds", "Longest call of a stage in the last run",
+           [({"stage": k}, v["max"]) for k, v in stages])
+    metric("events", "Events counted in the last run",
+           [({"name": k}, v) for k, v in sorted(s["counters"].items())])
+    if "requests_per_code" in s:
+        metric("requests_per_code", "SHiFT requests per redeemed code",
+               [(None, s["requests_per_code"])])
+    return "\n".join(lines) + "\n"
+
+
+def write_json(filename):
+    """Write the JSON run summary (atomically)"""
+    from store import FileBackend
+    FileBackend(filename).save(to_json())
+
+
+def write_prometheus(filename):
+    """Write a Prometheus textfile (atomically)"""
+    from store import FileBackend
+    FileBackend(filename).save(to_prometheus())
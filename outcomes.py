@@ -0,0 +1,120 @@
+#############################################################################
+#
+# Copyright (C) 2018 Fabian Schweinfurth
+# Contact: autoshift <at> derfabbi.de
+#
+# This file is part of autoshift
+#
+# autoshift is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autoshift is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with autoshift.  If not, see <http://www.gnu.org/licenses/>.
+#
+#############################################################################
+"""Cache of code outcomes that are the same for every platform and account.
+
+If looking up a code tells us it expired (or it doesn't exist), there
+is no point in trying it again for another platform or another account.
+Outcomes are stored by code in a `store` backend and trusted for a time
+that depends on the status.
+
+Only results of the code lookup that SHiFT spelled out are cached. A
+bare error (500) might have been a hiccup and a code that just isn't
+available for one platform is not dead.
+
+Entry points and accounts share outcomes if they use the same backend
+(see `backend`), e.g. `AUTOSHIFT_OUTCOMES=dynamodb:autoshift` for the
+table of the Lambda. Without it `ShiftClient` uses a file next to its
+session.
+"""
+import json
+import threading
+from time import time
+
+OUTCOMES_FILE = "outcomes.json"
+# where to keep outcomes: a file name or dynamodb:<table> (see `backend`)
+OUTCOMES_ENV = "AUTOSHIFT_OUTCOMES"
+# item of the outcomes in a table of the Lambda (see `fetch.ShiftCode`)
+DYNAMODB_KEY = {"shiftCode": "__outcomes__", "tweetTime": 0}
+# seconds an outcome (by status name) is trusted. None: forever
+TTL = {
+    "EXPIRED": None,
+    # "not available". codes might show up a bit early
+    "INVALID": 24 * 60 * 60,
+}
+
+
+def backend(spec):
+    """`store` backend for a file name or `dynamodb:<table>`"""
+    import store
+    if spec.startswith("dynamodb:"):
+        import boto3
+        table = boto3.resource("dynamodb").Table(spec[len("dynamodb:"):])
+        return store.DynamoDBBackend(table, DYNAMODB_KEY)
+    return store.FileBackend(spec)
+
+
+class OutcomeCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.entries = None
+        # lookups we didn't have to do
+        self.hits = 0
+
+    def __read(self):
+        try:
+            ret = json.loads(self.backend.load() or "{}")
+        except ValueError:
+            ret = {}
+        return ret if isinstance(ret, dict) else {}
+
+    def __load(self):
+        if self.entries is None:
+            self.entries = self.__read()
+        return self.entries
+
+    def get(self, code, now=None):
+        """Name of the cached status of `code` (or None)"""
+        now = time() if now is None else now
+        with self.lock:
+            entry = self.__load().get(code)
+            if entry is None:
+                return None
+            ttl = TTL.get(entry.get("status"), 0)
+            if ttl is not None and now - entry.get("at", 0) >= ttl:
+                del self.entries[code]
+                return None
+            self.hits += 1
+            return entry["status"]
+
+    def put(self, code, status, now=None):
+        """Remember the outcome (status name) of a code lookup
+
+        Statuses without a TTL aren't cached"""
+        if status not in TTL:
+            return False
+        now = time() if now is None else now
+        with self.lock:
+            entries = self.__load()
+            entries[code] = {"status": status, "at": int(now)}
+            # keep what other processes added in the meantime
+            merged = self.__read()
+            merged.update(entries)
+            self.entries = merged
+            self.backend.save(json.dumps(merged, separators=(",", ":")))
+        return True
+
+    def forget(self, code):
+        with self.lock:
+            if self.__load().pop(code, None) is not None:
+                self.backend.save(json.dumps(self.entries,
+                                             separators=(",", ":")))
@@ -0,0 +1,62 @@
+#############################################################################
+#
+# Copyright (C) 2018 Fabian Schweinfurth
+# Contact: autoshift <at> derfabbi.de
+#
+# This file is part of autoshift
+#
+# autoshift is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autoshift is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with autoshift.  If not, see <http://www.gnu.org/licenses/>.
+#
+#############################################################################
+"""Pick the golden keys to redeem under `--limit`.
+
+Every redemption of a golden code adds its number of golden keys to the
+account and we may not go over the limit. Which (code, platform)
+redemptions give the most golden keys is a subset sum problem. It is
+solved exactly with a DP over the reachable sums, kept as bits of a
+single int: bit `s` is set if some subset sums up to `s`. Adding an item
+of weight `w` is then `reach | reach << w` which is fast even for
+thousands of items.
+"""
+
+
+def plan(weights, limit):
+    """Indices of the `weights` with the largest sum not above `limit`
+
+    Of all subsets with that sum, the one using the lowest indices is
+    picked (so order the candidates by preference)."""
+    if limit <= 0:
+        return []
+    if sum(weights) <= limit:
+        return [i for i, w in enumerate(weights) if w > 0]
+
+    mask = (1 << (limit + 1)) - 1
+    reach = 1
+    # reachable sums before each item
+    history = []
+    for w in weights:
+        history.append(reach)
+        if w > 0:
+            reach = (reach | (reach << w)) & mask
+
+    best = reach.bit_length() - 1
+    chosen = []
+    # walk back: only take an item if its sum can't be reached without it
+    for i in range(len(weights) - 1, -1, -1):
+        if weights[i] <= 0 or (history[i] >> best) & 1:
+            continue
+        chosen.append(i)
+        best -= weights[i]
+    chosen.reverse()
+    return chosen
@@ -19,156 +19,537 @@
 # along with autoshift.  If not, see <http://www.gnu.org/licenses/>.
 #
 #############################################################################
-import sqlite3
-
-import requests
-from bs4 import BeautifulSoup as BSoup
-
+import hashlib
+import heapq
+import re
+import threading
+from collections import namedtuple
+from datetime import datetime, timezone
+from functools import lru_cache
+from itertools import chain
+from time import perf_counter, time
+
+import extract
+import metrics
+import storage
+import transport
 from common import _L, DIRNAME
 
 platforms = ["steam", "epic", "ps", "xbox"]
 # will be filled later
 games = []
 game_funcs = {}
-
-
-conn = None
-c = None
-
-
-def registerParser(*the_games):
+# seconds between two fetches of a game's source
+game_intervals = {}
+# for parsers that don't specify one (fetch on every run)
+DEFAULT_INTERVAL = 0
+# scheduled runs don't start exactly on time
+INTERVAL_SLACK = 5 * 60
+# results of `parse_keys` during this run (see `reset_parsed`)
+parsed = {}
+# seconds each source took to fetch and parse during this run
+parse_times = {}
+# number of sources fetched at the same time
+PARSE_WORKERS = 4
+
+# HTTP validators, content digest and time of the last fetch per source
+# (table `sources`. see `fetch_source`)
+SOURCE_COLUMNS = ("url", "etag", "last_modified", "size", "digest",
+                  "last_fetched")
+source_cache = None
+# new cache entries. saved once their keys are in the database
+pending_sources = {}
+fetch_stats = {"hits": 0, "misses": 0, "unchanged": 0, "bytes_saved": 0,
+               "skipped": 0}
+# sources are fetched concurrently (see `parse_all`)
+source_lock = threading.RLock()
+
+
+DB_FILE = "keys.db"
+# `storage.Database` (see `open_db`)
+db = None
+
+# quite general regex..
+# you never know what they write in those tables..
+GOLDEN_REG = re.compile(r"^(\d+).*gold.*", re.I)
+
+
+def registerParser(*the_games, **kwargs):
     """Register parser for specified games.
 
+    A parser yields the keys of all platforms. It is called once per
+    game and run (with `platform` set to None), but not more often than
+    every `interval` seconds. Register the same parser again for games
+    with another interval.
+    Keys may have a 5th element: the time they expire (timestamp,
+    `EXPIRED` if they expired at an unknown time, None if unknown).
+
     e.g:
 
-        @registerParser("bl3")
+        @registerParser("bl3", interval=60 * 60)
         def parse_bl3(game, platform):
             description = "some key"
             code = "AAAA-BBBBB-CCCCC-DDDDD"
-            yield description, code, platform, game
+            yield description, code, "pc", game
     """
+    interval = kwargs.get("interval", DEFAULT_INTERVAL)
+
     def decorator(f):
         global game_funcs, games
         for game in the_games:
             game_funcs[game] = f
-            games.append(game)
+            game_intervals[game] = interval
+            if game not in games:
+                games.append(game)
         return f
     return decorator
 
 
-class Key:
-    """small class like `functools.namedtuple` but with settable attributes"""
-    __slots__ = ("id", "description", "key", "redeemed")
-    def __init__(self, *args, **kwargs): # noqa
-        for el in Key.__slots__:
-            setattr(self, el, None)
-        for i, el in enumerate(args):
-            setattr(self, Key.__slots__[i], el)
-        for k in kwargs:
-            setattr(self, k, kwargs[k])
-    def __str__(self): # noqa
-        return "Key({})".format(
-            ", ".join([str(getattr(self, k))
-                       for k in Key.__slots__]))
-    def __repr__(self): # noqa
-        return str(self)
+# a row of `keys` (immutable. see `set_redeemed`)
+Key = namedtuple("Key", ("id", "description", "key", "redeemed",
+                         "golden_count", "platform", "expires"))
+# `expires` of keys that are known to be expired (but not since when)
+EXPIRED = 0
+KEY_COLUMNS = ", ".join(Key._fields)
+# rows fetched at once by `iter_keys`
+PAGE_SIZE = 1000
 
 
 def open_db():
+    """Open (and migrate) the database. Does nothing if it is open already"""
     from os import path, makedirs
-    global conn, c
+    global db
+    if db is not None:
+        return db
     makedirs(path.join(DIRNAME, "data"), exist_ok=True)
-    conn = sqlite3.connect(path.join(DIRNAME, "data", "keys.db"),
-                           detect_types=sqlite3.PARSE_DECLTYPES)
-    c = conn.cursor()
+    db = storage.Database(path.join(DIRNAME, "data", DB_FILE))
+    with db.transaction() as c:
+        _migrate(c)
+    return db
 
+
+def _migrate(c):
     c.execute("CREATE TABLE IF NOT EXISTS keys "
               "(id INTEGER primary key, description TEXT, "
               "key TEXT, platform TEXT, game TEXT, redeemed INTEGER)")
 
+    # one row per key. older databases may contain duplicates
+    if not c.execute("SELECT name FROM sqlite_master "
+                     "WHERE type='index' AND name='keys_unique'").fetchone():
+        # a key is redeemed if any of its copies is
+        c.execute("UPDATE keys SET redeemed=1 WHERE id IN "
+                  "(SELECT MIN(id) FROM keys GROUP BY platform, key, game "
+                  "HAVING MAX(redeemed)=1)")
+        c.execute("DELETE FROM keys WHERE id NOT IN "
+                  "(SELECT MIN(id) FROM keys GROUP BY platform, key, game)")
+        c.execute("CREATE UNIQUE INDEX keys_unique "
+                  "ON keys(platform, key, game)")
+
+    # precomputed number of golden keys per code (see `golden_count`)
+    columns = [row[1] for row in c.execute("PRAGMA table_info(keys)")]
+    if "golden_count" not in columns:
+        c.execute("ALTER TABLE keys "
+                  "ADD COLUMN golden_count INTEGER NOT NULL DEFAULT 0")
+        rows = c.execute("SELECT id, description FROM keys").fetchall()
+        c.executemany("UPDATE keys SET golden_count=? WHERE id=?",
+                      [(golden_count(desc), id_) for id_, desc in rows])
+
+    c.execute("CREATE INDEX IF NOT EXISTS keys_lookup "
+              "ON keys(platform, game, redeemed, id)")
+
+    # timestamp the key expires at (NULL: unknown)
+    if "expires" not in columns:
+        c.execute("ALTER TABLE keys ADD COLUMN expires REAL")
+    c.execute("CREATE INDEX IF NOT EXISTS keys_expiry "
+              "ON keys(platform, game, redeemed, expires, id) "
+              "WHERE expires IS NOT NULL")
+
+    c.execute("CREATE TABLE IF NOT EXISTS sources "
+              "(source TEXT primary key, url TEXT, etag TEXT, "
+              "last_modified TEXT, size INTEGER, digest TEXT, "
+              "last_fetched REAL)")
+
 
 def close_db():
-    conn.commit()
-    conn.close()
-
-
-def insert(desc, code, platform, game):
-    """Insert Key"""
-    el = c.execute("""SELECT * FROM keys
-                   WHERE platform = ?
-                   AND key = ?
-                   AND game = ?""",
-                   (platform, code, game))
-    if el.fetchone():
-        return
-    _L.debug("== inserting {} Key '{}' for {} ==".format(game.upper(), code,
-                                                         platform.upper()))
-    c.execute("INSERT INTO keys(description, key, platform, game, redeemed) "
-              "VAlUES (?,?,?,?,0)", (desc, code, platform, game))
-    conn.commit()
+    global db
+    if db is not None:
+        db.close()
+        db = None
+
+
+def golden_count(description):
+    """Number of golden keys a code with this description unlocks"""
+    m = GOLDEN_REG.match(description or "")
+    return int(m.group(1)) if m else 0
+
+
+INSERT_CMD = ("INSERT OR IGNORE INTO keys"
+              "(description, key, platform, game, redeemed, golden_count, "
+              "expires) VALUES (?,?,?,?,0,?,?)")
+# sources may learn about the expiry of known keys
+EXPIRES_CMD = ("UPDATE keys SET expires=? "
+               "WHERE platform=? AND key=? AND game=? "
+               "AND (expires IS NULL OR expires<>?)")
+
+
+def insert(desc, code, platform, game, expires=None):
+    """Insert Key. Returns False if it was already known (or expired)"""
+    inserted, _ = insert_many([(desc, code, platform, game, expires)])
+    if not inserted:
+        return False
+    _L.debug("== inserting %s Key '%s' for %s ==", game.upper(), code,
+             platform.upper())
+    return True
+
+
+@metrics.timed("db.insert")
+def insert_many(codes):
+    """Insert (desc, code, platform, game[, expires]) tuples in one transaction
+
+    Expiry times of known keys are updated. Keys that are expired
+    already aren't inserted.
+    Returns number of inserted and skipped (known or expired) keys"""
+    now = time()
+    rows = []
+    expiries = []
+    n = 0
+    for el in codes:
+        n += 1
+        desc, code, platform, game = el[:4]
+        expires = el[4] if len(el) > 4 else None
+        if expires is not None:
+            expiries.append((expires, platform, code, game, expires))
+            if expires <= now:
+                continue
+        rows.append((desc, code, platform, game, golden_count(desc), expires))
+
+    with db.transaction() as c:
+        c.executemany(EXPIRES_CMD, expiries)
+        before = c.total_changes
+        c.executemany(INSERT_CMD, rows)
+        inserted = c.total_changes - before
+    metrics.count("db.inserted", inserted)
+    return inserted, n - inserted
+
+
+def db_platform(platform):
+    """Platform the keys of `platform` are stored for (steam, epic: pc)"""
+    if (platform not in ["xbox", "ps"]):
+        return "pc"
+    return platform
 
 
-def get_keys(platform, game, all_keys=False):
-    """Get all (unredeemed) keys of given platform and game"""
-    if (platform not in ["xbox", "ps"]):
-        platform = "pc"
+def _key_filter(platform, game, all_keys, golden):
+    """WHERE clause and params for `get_keys` and co."""
+    platform = db_platform(platform)
     cmd = """
-        SELECT id, description, key, redeemed FROM keys
         WHERE platform=?
         AND game=?"""
     if not all_keys:
         cmd += " AND redeemed=0"
-    cmd += " ORDER BY id DESC"
-    ex = c.execute(cmd, (platform, game))
-
-    keys = []
-    for row in ex:
-        keys.append(Key(*row))
+    if golden is not None:
+        cmd += " AND golden_count > 0" if golden else " AND golden_count = 0"
+    return cmd, (platform, game)
+
+
+def _key_row(cursor, row):
+    return Key._make(row)
+
+
+def _iter_platform_keys(platform, game, all_keys, golden, page_size,
+                        expiring):
+    where, params = _key_filter(platform, game, all_keys, golden)
+    cmd = "SELECT " + KEY_COLUMNS + " FROM keys" + where
+    if expiring:
+        cmd += " AND expires IS NOT NULL"
+        order = " ORDER BY expires, id DESC"
+        after = " AND (expires > ? OR (expires = ? AND id < ?))"
+    else:
+        cmd += " AND expires IS NULL"
+        order = " ORDER BY id DESC"
+        after = " AND id < ?"
+    cur = db.conn.cursor()
+    cur.row_factory = _key_row
+    if not page_size:
+        for key in cur.execute(cmd + order, params):
+            yield key
+        return
 
-    return keys
+    # keyset pagination: no cursor stays open between two pages
+    with metrics.timer("db.keys_page"):
+        page = cur.execute(cmd + order + " LIMIT ?",
+                           params + (page_size, )).fetchall()
+    while page:
+        for key in page:
+            yield key
+        if len(page) < page_size:
+            return
+        last = page[-1]
+        if expiring:
+            last = (last.expires, last.expires, last.id)
+        else:
+            last = (last.id, )
+        with metrics.timer("db.keys_page"):
+            page = cur.execute(cmd + after + order + " LIMIT ?",
+                               params + last + (page_size, )).fetchall()
+
+
+def iter_keys(platform, game, all_keys=False, golden=None,
+              page_size=PAGE_SIZE):
+    """Yield (unredeemed) keys of given platform(s) and game
+
+    Keys with a known expiry come first, the soonest expiring first. Keys
+    without one (never or unknown) follow, newest first.
+    `platform` may be a list of platforms. Keys are read `page_size` at a
+    time (all at once if it is 0), so keys can be set redeemed while
+    iterating.
+    only golden keys if `golden` is True, only non-golden keys if False"""
+    if isinstance(platform, str):
+        platform = [platform]
+    platform = sorted(set(db_platform(el) for el in platform))
+
+    def merged(expiring, key):
+        streams = [_iter_platform_keys(el, game, all_keys, golden, page_size,
+                                       expiring)
+                   for el in platform]
+        if len(streams) == 1:
+            return streams[0]
+        return heapq.merge(*streams, key=key)
+
+    return chain(merged(True, lambda key: (key.expires, -key.id)),
+                 merged(False, lambda key: -key.id))
+
+
+@metrics.timed("db.retire_expired")
+def retire_expired(now=None):
+    """Set all keys redeemed that are known to be expired by `now`
+
+    Returns the number of retired keys"""
+    now = time() if now is None else now
+    with db.transaction() as c:
+        return c.execute("UPDATE keys SET redeemed=1 WHERE redeemed=0 "
+                         "AND expires IS NOT NULL AND expires <= ?",
+                         (now, )).rowcount
+
+
+@metrics.timed("db.get_keys")
+def get_keys(platform, game, all_keys=False, golden=None):
+    """Get all (unredeemed) keys of given platform and game
+
+    only golden keys if `golden` is True, only non-golden keys if False"""
+    return list(iter_keys(platform, game, all_keys, golden, page_size=0))
+
+
+def count_golden_keys(platform, game, all_keys=False):
+    """Total number of golden keys of given platform and game"""
+    where, params = _key_filter(platform, game, all_keys, True)
+    return int(db.execute("SELECT TOTAL(golden_count) FROM keys" + where,
+                          params).fetchone()[0])
 
 
 def get_special_keys(platform, game):
-    keys = get_keys(platform, game)
-    num = 0
-    ret = []
-    for k in keys:
-        if "gold" not in k.description.lower():
-            num += 1
-            ret.append(k)
-    return num, ret
+    keys = get_keys(platform, game, golden=False)
+    return len(keys), keys
 
 
 def get_golden_keys(platform, game, all_keys=False):
-    import re
-    # quite general regex..
-    # you never know what they write in those tables..
-    g_reg = re.compile(r"^(\d+).*gold.*", re.I)
-    keys = get_keys(platform, game, all_keys)
-    num = 0
-    ret = []
-    for k in keys:
-        m = g_reg.match(k.description)
-        if m:
-            num += int(m.group(1))
-            ret.append(k)
-    return num, ret
+    keys = get_keys(platform, game, all_keys, golden=True)
+    return count_golden_keys(platform, game, all_keys), keys
 
 
+@metrics.timed("db.set_redeemed")
 def set_redeemed(key):
-    key.redeemed = 1
-    c.execute("UPDATE keys SET redeemed=1 WHERE id=(?)", (key.id, ))
-    conn.commit()
-
-
-def parse_keys(game, platform):
+    """Set key (or anything with its `id`) redeemed in the database"""
+    with db.transaction() as c:
+        c.execute("UPDATE keys SET redeemed=1 WHERE id=(?)", (key.id, ))
+
+
+def _source_entry(source):
+    with source_lock:
+        if source in pending_sources:
+            return pending_sources[source]
+        return dict(source_cache.get(source, {}))
+
+
+def load_sources():
+    """Read the source cache from the database (in the calling thread)"""
+    global source_cache
+    rows = db.execute("SELECT source, " + ", ".join(SOURCE_COLUMNS)
+                      + " FROM sources").fetchall()
+    with source_lock:
+        source_cache = {row[0]: {k: v for k, v in zip(SOURCE_COLUMNS, row[1:])
+                                 if v is not None}
+                        for row in rows}
+
+
+def source_due(source, now=None):
+    """Is it time to fetch `source` again?"""
+    now = time() if now is None else now
+    last = _source_entry(source).get("last_fetched")
+    interval = game_intervals.get(source, DEFAULT_INTERVAL)
+    return last is None or now - last >= interval - INTERVAL_SLACK
+
+
+@metrics.timed("query.fetch")
+def fetch_source(source, url):
+    """GET url, revalidating with what we know about `source`.
+
+    Returns the (streamed) response or None if it didn't change since
+    the last time."""
+    entry = _source_entry(source)
+    headers = {}
+    if entry.get("url") == url:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    r = transport.shared_session().get(url, headers=headers, stream=True)
+    _L.debug("%s %s %s", r.request.method, r.url, r.status_code)
+    if r.status_code not in (200, 304):
+        # error pages are no (empty) code tables
+        r.close()
+        r.raise_for_status()
+        raise IOError("unexpected reply {} {}".format(r.status_code, r.reason))
+    # only successful fetches count. they are committed along with their
+    # keys (see `commit_source`)
+    with source_lock:
+        entry["last_fetched"] = time()
+        pending_sources[source] = entry
+        if r.status_code == 304:
+            r.close()
+            fetch_stats["hits"] += 1
+            metrics.count("query.not_modified")
+            fetch_stats["bytes_saved"] += entry.get("size", 0)
+            return None
+
+        fetch_stats["misses"] += 1
+        entry.update(url=url,
+                     etag=r.headers.get("ETag"),
+                     last_modified=r.headers.get("Last-Modified"),
+                     size=int(r.headers.get("Content-Length") or 0))
+    return r
+
+
+def source_changed(source, digest):
+    """Check (and remember) if the relevant content of a source changed
+
+    `digest`: hex digest of that content"""
+    with source_lock:
+        entry = _source_entry(source)
+        if entry.get("digest") == digest:
+            fetch_stats["unchanged"] += 1
+            return False
+        entry["digest"] = digest
+        pending_sources[source] = entry
+    return True
+
+
+def commit_source(source):
+    """Save cache entry of source (after its keys got inserted)"""
+    with source_lock:
+        if source not in pending_sources:
+            return
+        entry = source_cache[source] = pending_sources.pop(source)
+    with db.transaction() as c:
+        c.execute("INSERT OR REPLACE INTO sources (source, {}) "
+                  "VALUES (?, {})".format(", ".join(SOURCE_COLUMNS),
+                                          ", ".join("?" * len(SOURCE_COLUMNS))),
+                  (source, ) + tuple(entry.get(k) for k in SOURCE_COLUMNS))
+
+
+def forget_source(source):
+    """Fetch and parse source again next time"""
+    with source_lock:
+        pending_sources.pop(source, None)
+        source_cache.pop(source, None)
+    with db.transaction() as c:
+        c.execute("DELETE FROM sources WHERE source=?", (source, ))
+
+
+def reset_parsed():
+    """Forget which games were parsed. Call at the start of each run"""
+    global source_cache
+    parsed.clear()
+    parse_times.clear()
+    pending_sources.clear()
+    source_cache = None
+    for k in fetch_stats:
+        fetch_stats[k] = 0
+
+
+def parse_keys(game, platform=None, force=False):
+    """Parse and insert new keys (of all platforms).
+
+    Each game is only parsed once until `reset_parsed` is called.
+    Returns number of inserted and skipped (known) keys"""
     if game not in games:
         _L.error("No known method of retrieving new SHiFT codes "
                  "for the game `{}`".format(game))
-        return
-
-    for code in game_funcs[game](game, platform):
-        insert(*code)
+        return 0, 0
+
+    parse_all([game], force=force)
+    return parsed[game]
+
+
+def _run_parser(game):
+    """Fetch and parse a source (in a worker thread)"""
+    start = perf_counter()
+    keys = list(game_funcs[game](game, None))
+    return keys, perf_counter() - start
+
+
+@metrics.timed("query.parse_all")
+def parse_all(the_games, workers=PARSE_WORKERS, force=False):
+    """Parse keys of all given games concurrently.
+
+    Sources are fetched and parsed in up to `workers` threads. All
+    keys (and source cache entries) are written by the calling thread.
+    Sources that were fetched less than their interval ago are skipped
+    unless `force` is set.
+    Returns dict with number of inserted and skipped keys per game"""
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    if source_cache is None:
+        load_sources()
+
+    todo = []
+    for game in the_games:
+        if game not in games:
+            _L.error("No known method of retrieving new SHiFT codes "
+                     "for the game `{}`".format(game))
+        elif game not in parsed and game not in todo:
+            todo.append(game)
+            # sources without a row in `sources` are always due. Don't look
+            # at `keys`: a source with only expired codes adds nothing there
+            if not (force or source_due(game)):
+                _L.debug("== %s keys are not due yet ==", game.upper())
+                todo.pop()
+                parsed[game] = (0, 0)
+                fetch_stats["skipped"] += 1
+                metrics.count("query.not_due")
+    if todo:
+        with ThreadPoolExecutor(min(workers, len(todo))) as executor:
+            futures = {executor.submit(_run_parser, game): game
+                       for game in todo}
+            for future in as_completed(futures):
+                game = futures[future]
+                try:
+                    keys, parse_times[game] = future.result()
+                except Exception as e:
+                    _L.error("Could not parse {} keys: {}"
+                             .format(game.upper(), e))
+                    # try again next time
+                    pending_sources.pop(game, None)
+                    parsed[game] = (0, 0)
+                    continue
+
+                parsed[game] = insert_many(keys)
+                commit_source(game)
+                _L.debug("== inserted %d new %s Keys in %.2fs ==",
+                         parsed[game][0], game.upper(), parse_times[game])
+
+    return {game: parsed[game] for game in the_games if game in parsed}
 
 
 # @registerParser("bl3")
@@ -186,52 +567,119 @@ def parse_keys(game, platform):
 #         for i in range(5, len(platforms)):
 #             print(cols[i])
 
-@registerParser("bl", "bl2", "blps", "bl3")
-def parse_bl2blps(game, platform):
-    """Get all Keys from orcz"""
-    key_urls = {"bl": "http://orcz.com/Borderlands:_Golden_Key",
-                "bl2": "http://orcz.com/Borderlands_2:_Golden_Key",
-                "blps": "http://orcz.com/Borderlands_Pre-Sequel:_Shift_Codes",
-                "bl3": "http://orcz.com/Borderlands_3:_Golden_Key"
-                }
-
-    def check(key):
-        """Check if key is expired (return None if so)"""
-        ret = None
-        span = key.find("span")
-        if (not span) or (not span.get("style")) or ("black" in span["style"]):
-            ret = key.text.strip()
-
-            # must be of format ABCDE-FGHIJ-KLMNO-PQRST
-            if ret.count("-") != 4:
-                return None
-            spl = ret.split("-")
-            spl = [len(el) == 5 for el in spl]
-            if not all(spl):
-                return None
-
-        return ret
-
-    r = requests.get(key_urls[game])
-    soup = BSoup(r.text, "lxml")
-    table = soup.find("table")
-    rows = table.find_all("tr")[1:]
-    for row in rows:
-        cols = row.find_all("td")
-        desc = cols[1].text.strip()
-        codes = [None, None, None]
-        for i in range(4, 7):
-            try:
-                codes[i - 4] = check(cols[i])
-            except Exception as e: # noqa
-                _L.debug(e)
-                pass
+ORCZ_URLS = {"bl": "http://orcz.com/Borderlands:_Golden_Key",
+             "bl2": "http://orcz.com/Borderlands_2:_Golden_Key",
+             "blps": "http://orcz.com/Borderlands_Pre-Sequel:_Shift_Codes",
+             "bl3": "http://orcz.com/Borderlands_3:_Golden_Key"
+             }
+
+
+# bytes read at once from source pages
+CHUNK_SIZE = 16 * 1024
+
+
+# formats of the "Expires" column on orcz
+DATE_FORMATS = ["%b %d, %Y", "%B %d, %Y", "%b %d %Y", "%B %d %Y",
+                "%Y-%m-%d", "%m/%d/%Y", "%d %B %Y"]
+
+
+def _check_code(cell):
+    """(code, expired) in table cell (code is None if there is no code)"""
+    span = cell.find(".//span")
+    style = span.get("style") if span is not None else None
+    # codes in color (but black) are expired
+    expired = bool(style) and "black" not in style
+    ret = cell.text_content().strip()
+
+    # must be of format ABCDE-FGHIJ-KLMNO-PQRST
+    if ret.count("-") != 4:
+        return None, expired
+    spl = ret.split("-")
+    spl = [len(el) == 5 for el in spl]
+    if not all(spl):
+        return None, expired
+
+    return ret, expired
 
-        codes.insert(1, None)
+
+@lru_cache(maxsize=256)
+def _parse_expires(text):
+    """Timestamp of the end of the day in the "Expires" column (or None)
+
+    The day ends in UTC, no matter where we run (the Lambda runs in UTC)"""
+    text = " ".join(text.split())
+    if text.lower().startswith("expired"):
+        return EXPIRED
+    if not any(ch.isdigit() for ch in text):
+        # "Never", "Unknown", ...
+        return None
+    # e.g. "Oct 31, 2019 10AM PST". the day is good enough
+    words = text.split(" ")
+    for n in (3, 1):
+        for fmt in DATE_FORMATS:
+            try:
+                day = datetime.strptime(" ".join(words[:n]), fmt)
+            except ValueError:
+                continue
+            return day.replace(hour=23, minute=59, second=59,
+                               tzinfo=timezone.utc).timestamp()
+    return None
+
+
+def orcz_codes(chunks, game, encoding=None):
+    """Yield (desc, code, platform, game, expires) of an orcz page as it is
+    parsed"""
+    for cols in extract.table_rows(chunks, encoding):
+        # header row (th) and broken rows
+        if len(cols) < 2:
+            continue
+        desc = cols[1].text_content().strip()
+        expires = None
+        if len(cols) > 3:
+            expires = _parse_expires(cols[3].text_content())
+        codes = [(None, False)] * 3
+        for i in range(4, min(7, len(cols))):
+            codes[i - 4] = _check_code(cols[i])
+
+        codes.insert(1, (None, False))
 
         for i in range(len(codes)):
-            if codes[i]:
+            code, expired = codes[i]
+            if code:
                 the_platform = platforms[i]
                 if platforms[i] in ["steam", "epic"]:
                     the_platform = "pc"
-                yield desc, codes[i], the_platform, game
+                yield (desc, code, the_platform, game,
+                       EXPIRED if expired else expires)
+
+
+@registerParser("bl3", interval=60 * 60)
+@registerParser("bl2", "blps", interval=6 * 60 * 60)
+@registerParser("bl", interval=24 * 60 * 60)
+def parse_bl2blps(game, platform):
+    """Get all Keys from orcz"""
+    r = fetch_source(game, ORCZ_URLS[game])
+    if r is None:
+        # not modified
+        return
+    try:
+        digest = hashlib.sha1()
+        codes = []
+        # the body is downloaded while it is parsed
+        with metrics.timer("query.parse_html"):
+            for code in orcz_codes(r.iter_content(CHUNK_SIZE), game,
+                                   r.encoding):
+                digest.update(repr(code).encode("utf8"))
+                codes.append(code)
+    finally:
+        # don't download the rest of the page
+        r.close()
+
+    if not codes:
+        # not a code table (maintenance page or so). Don't remember it as
+        # fetched, try again next run
+        raise ValueError("no codes found on {}".format(r.url))
+    if not source_changed(game, digest.hexdigest()):
+        return
+    for code in codes:
+        yield code
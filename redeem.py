@@ -1,21 +1,23 @@
 import calendar
 import json
 import os
+import time
 
 import boto3
 from botocore.exceptions import ClientError
 
 from dateutil.parser import *
-from fetch import ShiftCode
+import outcomes
+from fetch import ShiftCode, expire_timestamp
 from shift import ShiftClient
 
 
-def handler_redeem(event, context):
+# kept across warm invocations
+shift_client = None
 
-    ssm_client = boto3.client("ssm")
-    sqs_client = boto3.client("sqs")
 
-    shift_username, shift_password, shift_client = None, None, None
+def login(ssm_client):
+    shift_username, shift_password = None, None
 
     try:
         shift_username = ssm_client.get_parameter(Name='/{}/shift_login/username'.format(
@@ -28,9 +30,42 @@ def handler_redeem(event, context):
         exit(ssm_error)
 
     if shift_username is not None and shift_password is not None:
-        shift_client = ShiftClient(user=shift_username["Parameter"]["Value"],
-                                   pw=shift_password["Parameter"]["Value"],
-                                   cookiedir='/tmp')
+        # share dead codes with other accounts (and auto.py)
+        outcome_cache = os.getenv(outcomes.OUTCOMES_ENV) or "dynamodb:{}".format(
+            os.getenv('DYNAMODB_TABLE_NAME', 'autoshift'))
+        return ShiftClient(user=shift_username["Parameter"]["Value"],
+                           pw=shift_password["Parameter"]["Value"],
+                           cookiedir='/tmp',
+                           outcome_cache=outcome_cache)
+    return None
+
+
+def delete_message(sqs_client, rec):
+    queue_name = os.getenv('REDEEM_QUEUE_NAME', 'shift_code_redeem')
+    sqs_url = sqs_client.get_queue_url(QueueName=queue_name)["QueueUrl"]
+    sqs_client.delete_message(QueueUrl=sqs_url, ReceiptHandle=rec["receiptHandle"])
+
+
+def retire_expired(msg_body):
+    """Mark a code as expired in the database (without redeeming it)"""
+    tweet_timestamp = calendar.timegm(parse(msg_body["tweet_created"]).timetuple())
+    try:
+        shift_item = ShiftCode.get(msg_body['code'], tweet_timestamp)
+        shift_item.update(actions=[ShiftCode.expired.set(True)])
+    except Exception as db_write_err:
+        print("FAILURE : Could not mark {} as expired.".format(msg_body["code"]))
+        print(db_write_err)
+
+
+def handler_redeem(event, context):
+    global shift_client
+
+    ssm_client = boto3.client("ssm")
+    sqs_client = boto3.client("sqs")
+
+    # the client (and its connection pool) survives warm invocations
+    if shift_client is None:
+        shift_client = login(ssm_client)
 
     for rec in event['Records']:
         msg_body = None
@@ -39,6 +74,14 @@ def handler_redeem(event, context):
         except json.JSONDecodeError as e:
             exit(e)
 
+        # don't spend one of the hourly redemptions on an expired code
+        expires = expire_timestamp(msg_body)
+        if expires is not None and expires <= time.time():
+            print("SKIPPED : SHiFT code {} expired already.".format(msg_body["code"]))
+            retire_expired(msg_body)
+            delete_message(sqs_client, rec)
+            continue
+
         # only redeem for epic right now.
         platform = 'epic'
         redeemed = shift_client.redeem(msg_body["code"], platform)
@@ -72,9 +115,7 @@ def handler_redeem(event, context):
                 if updated_item_attrs["attribute_values"]["redeemed"]:
                     print("SUCCESS : SHiFT code redeem status updated in database.")
                     print("Deleting message from queue")
-                    queue_name = os.getenv('REDEEM_QUEUE_NAME', 'shift_code_redeem')
-                    sqs_url = sqs_client.get_queue_url(QueueName=queue_name)["QueueUrl"]
-                    sqs_client.delete_message(QueueUrl=sqs_url, ReceiptHandle=rec["receiptHandle"])
+                    delete_message(sqs_client, rec)
                 else:
                     print("FAILURE : SHiFT code redeem state for {} not updated correctly.".format(msg_body["code"]))
 
@@ -0,0 +1,125 @@
+#############################################################################
+#
+# Copyright (C) 2018 Fabian Schweinfurth
+# Contact: autoshift <at> derfabbi.de
+#
+# This file is part of autoshift
+#
+# autoshift is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autoshift is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with autoshift.  If not, see <http://www.gnu.org/licenses/>.
+#
+#############################################################################
+"""Rate limit aware scheduling.
+
+SHiFT only allows a certain number of redemptions per hour and answers
+with TRYLATER afterwards. The time we hit that limit is persisted, so
+the scheduler can wake up exactly when redeeming is possible again and
+only fetch new codes in between.
+"""
+import json
+from datetime import datetime
+from os import path
+from time import time
+
+import store
+from common import _L, DIRNAME
+
+STATE_FILE = "ratelimit.json"
+# seconds until we can redeem again after hitting the limit (+ margin)
+LIMIT_WINDOW = 61 * 60
+# seconds between two runs
+INTERVAL = 65 * 60
+# seconds between two fetch only runs while we wait for the limit to reset
+FETCH_INTERVAL = 20 * 60
+
+
+class RateLimit:
+    def __init__(self, backend=None):
+        if backend is None:
+            backend = store.FileBackend(path.join(DIRNAME, "data",
+                                                  STATE_FILE))
+        self.backend = backend
+        self.hit_at = None
+        self.resume_at = None
+        self.load()
+
+    def load(self):
+        try:
+            state = json.loads(self.backend.load() or "{}")
+        except ValueError:
+            state = {}
+        self.hit_at = state.get("hit_at")
+        self.resume_at = state.get("resume_at")
+
+    def save(self):
+        self.backend.save(json.dumps({"hit_at": self.hit_at,
+                                      "resume_at": self.resume_at}))
+
+    def hit(self, now=None):
+        """We just hit the limit"""
+        now = time() if now is None else now
+        self.hit_at = now
+        self.resume_at = now + LIMIT_WINDOW
+        self.save()
+        _L.info("Reached the redemption limit. Resuming at {}"
+                .format(datetime.fromtimestamp(self.resume_at)
+                        .strftime("%H:%M:%S")))
+
+    def clear(self):
+        if self.resume_at is not None:
+            self.hit_at = self.resume_at = None
+            self.save()
+
+    def limited(self, now=None):
+        """Are we still waiting for the limit to reset?"""
+        now = time() if now is None else now
+        return self.resume_at is not None and now < self.resume_at
+
+    def next_run(self, now=None, interval=INTERVAL,
+                 fetch_interval=FETCH_INTERVAL):
+        """Time of the next run.
+
+        That's after `interval` seconds or as soon as the limit resets.
+        While we wait for that, new codes are fetched every
+        `fetch_interval` seconds"""
+        now = time() if now is None else now
+        ret = now + interval
+        if self.limited(now):
+            ret = min(ret, self.resume_at, now + fetch_interval)
+        return ret
+
+
+def run(job, ratelimit, interval=INTERVAL, fetch_interval=FETCH_INTERVAL):
+    """Call `job(fetch_only)` forever.
+
+    `fetch_only` is True while we wait for the rate limit to reset"""
+    from apscheduler.schedulers.blocking import BlockingScheduler
+    scheduler = BlockingScheduler()
+
+    def tick():
+        try:
+            job(ratelimit.limited())
+        finally:
+            run_date = datetime.fromtimestamp(ratelimit.next_run(
+                interval=interval, fetch_interval=fetch_interval))
+            _L.info("Next run at {}".format(run_date.strftime("%H:%M:%S")))
+            scheduler.add_job(tick, "date", run_date=run_date)
+
+    scheduler.add_job(tick, "date", run_date=datetime.fromtimestamp(
+        ratelimit.next_run(interval=interval,
+                           fetch_interval=fetch_interval)))
+
+    try:
+        scheduler.start()
+    except (KeyboardInterrupt, SystemExit):
+        pass
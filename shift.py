@@ -21,15 +21,52 @@
 #############################################################################
 from __future__ import print_function
 
-import pickle
-
-import requests
-from bs4 import BeautifulSoup as BSoup
-
+import random
+from collections import deque
+from time import time
+
+import extract
+import metrics
+import outcomes
+import store
+import transport
 from common import _L, DIRNAME
 
 base_url = "https://shift.gearboxsoftware.com"
 
+# login session (see `store`)
+SESSION_FILE = ".session.json"
+SESSION_COOKIE = "si"
+
+# seconds a CSRF token is reused before it is fetched again
+TOKEN_TTL = 15 * 60
+# reply of a code lookup without a CSRF token
+NO_TOKEN = "Could not retrieve Token"
+# reply of a code lookup or redemption if even a fresh token got rejected
+TOKEN_REJECTED = "CSRF token rejected"
+
+# redemption status polling (all in seconds):
+#   first delay, growth factor per attempt, max delay, +- jitter (relative)
+#   and overall deadline before falling back to the redirect.
+POLL_SCHEDULE = {"initial": 0.2,
+                 "factor": 1.5,
+                 "max_delay": 1.0,
+                 "jitter": 0.1,
+                 "deadline": 6.0}
+
+
+def poll_delays(initial, factor, max_delay, jitter, **_):
+    """Yield (endless) sleep times of a backoff schedule with jitter"""
+    delay = initial
+    while True:
+        yield max(0, delay * (1 + random.uniform(-jitter, jitter)))
+        delay = min(delay * factor, max_delay)
+
+
+def _count_request(r, *args, **kwargs):
+    """Response hook: count requests to SHiFT (see `metrics`)"""
+    metrics.count("shift.requests")
+
 
 def json_headers(token):
     return {'x-csrf-token': token,
@@ -39,7 +76,9 @@ def json_headers(token):
 # filthy enum hack with auto convert
 __els = ["NONE", "REDIRECT", "TRYLATER",
          "EXPIRED", "REDEEMED",
-         "SUCCESS", "INVALID", "UNKNOWN"]
+         "SUCCESS", "INVALID", "UNKNOWN",
+         # not tried: `abort` was set before the form got posted
+         "ABORTED"]
 def Status(n): # noqa
     return __els[n]
 for i in range(len(__els)): # noqa
@@ -103,14 +142,50 @@ def input_pw(qry):
 
 
 class ShiftClient:
-    def __init__(self, user=None, pw=None, cookiedir=None):
+    def __init__(self, user=None, pw=None, cookiedir=None,
+                 token_ttl=TOKEN_TTL, track_rewards=False, base_url=None,
+                 poll_schedule=None, session_store=None, outcome_cache=None):
+        import os
         from os import path
-        self.client = requests.session()
+        self.base_url = base_url or globals()["base_url"]
+        self.client = transport.session()
+        self.client.hooks["response"].append(_count_request)
+        # set to abort redemptions before their form gets posted
+        # (threading.Event or anything with `is_set`)
+        self.abort = None
         self.last_status = Status.NONE
-        if cookiedir is None:
-            self.cookie_file = path.join(DIRNAME, "data", ".cookies.save")
-        else:
-            self.cookie_file = path.join(cookiedir, '.cookies.save')
+        # reward list before the first redemption of this session.
+        # only queried if `track_rewards` is set or on demand
+        self.track_rewards = track_rewards
+        self.old_rewards = None
+        # cached CSRF token (see `__get_cached_token`)
+        self.token_ttl = token_ttl
+        self.__token = None
+        self.__token_time = 0
+        self.token_fetches = 0
+        self.token_fetches_saved = 0
+        # status polling schedule (see `POLL_SCHEDULE`)
+        self.poll_schedule = dict(POLL_SCHEDULE, **(poll_schedule or {}))
+        # (attempt, latency, elapsed since POST reply, done) of the last polls
+        self.poll_stats = deque(maxlen=1000)
+        self.poll_fallbacks = 0
+        if session_store is None:
+            if cookiedir is None:
+                cookiedir = path.join(DIRNAME, "data")
+            session_store = store.FileBackend(path.join(cookiedir,
+                                                        SESSION_FILE))
+        self.session_store = session_store
+        # outcomes of dead codes, shared by all platforms and all accounts
+        # (and entry points) using the same backend.
+        # `outcome_cache` may be an `outcomes.backend` spec
+        if outcome_cache is None:
+            outcome_cache = os.environ.get(outcomes.OUTCOMES_ENV) or path.join(
+                cookiedir or path.join(DIRNAME, "data"),
+                outcomes.OUTCOMES_FILE)
+        if isinstance(outcome_cache, str):
+            outcome_cache = outcomes.OutcomeCache(
+                outcomes.backend(outcome_cache))
+        self.outcome_cache = outcome_cache
         # try to load cookies. Query for login data if not present
         if not self.__load_cookie():
             print("First time usage: Login to your SHiFT account...")
@@ -126,62 +201,202 @@ class ShiftClient:
                 exit(0)
 
     def redeem(self, code, platform):
-        found, status_code, form_data = self.__get_redemption_form(code, platform)
+        metrics.count("shift.codes")
+        status = self.__cached_outcome(code)
+        if status is not None:
+            return status
+
+        found, status_code, forms = self.__lookup_code(code)
         # the expired message comes from even wanting to redeem
         if not found:
-            # entered key was invalid
-            if status_code == 500:
-                return Status.INVALID
-            # entered key expired by now
-            if "expired" in form_data:
-                return Status.EXPIRED
-            if "not available" in form_data:
-                return Status.INVALID
-            # unknown
-            _L.error(form_data)
-            return Status.UNKNOWN
+            return self.__lookup_failed(code, status_code, forms)
+
+        form_data = self.__form_data(forms, platform)
+        if form_data is None:
+            return self.__lookup_status(
+                status_code, "This code is not available for your platform")
 
         # the key is valid and all.
+        return self.__redeem(form_data)
+
+    def redeem_all(self, code, platforms):
+        """Redeem code for all given platforms with a single code lookup
+
+        Returns dict with the status of each platform"""
+        metrics.count("shift.codes")
+        status = self.__cached_outcome(code)
+        if status is not None:
+            return {platform: status for platform in platforms}
+
+        found, status_code, forms = self.__lookup_code(code)
+        if not found:
+            status = self.__lookup_failed(code, status_code, forms)
+            return {platform: status for platform in platforms}
+
+        ret = {}
+        for platform in platforms:
+            # don't spam if we reached the hourly limit
+            if Status.TRYLATER in ret.values():
+                ret[platform] = Status.TRYLATER
+                continue
+            form_data = self.__form_data(forms, platform)
+            if form_data is None:
+                ret[platform] = Status.INVALID
+                continue
+            ret[platform] = self.__redeem(form_data)
+        return ret
+
+    def __cached_outcome(self, code):
+        """Status of a code that is dead for everyone (or None)"""
+        status = self.outcome_cache.get(code)
+        if status is None:
+            return None
+        metrics.count("shift.cached_outcomes")
+        _L.debug("%s: cached outcome %s", code, status)
+        return getattr(Status, status)
+
+    def __lookup_failed(self, code, status_code, text):
+        """Status of a failed code lookup. Remembers dead codes"""
+        status = self.__lookup_status(status_code, text)
+        # only trust what they told us. a bare 500 might be a hiccup
+        # and without (a valid) token we didn't even get to ask about it
+        if status_code != 500 and text not in (NO_TOKEN, TOKEN_REJECTED):
+            self.outcome_cache.put(code, Status(status))
+        return status
+
+    def __lookup_status(self, status_code, text):
+        """Status of a failed code lookup"""
+        # entered key was invalid
+        if status_code == 500:
+            return Status.INVALID
+        # entered key expired by now
+        if "expired" in text:
+            return Status.EXPIRED
+        if "not available" in text:
+            return Status.INVALID
+        # unknown
+        _L.error(text)
+        return Status.UNKNOWN
+
+    def __redeem(self, form_data):
+        if self.track_rewards:
+            self.snapshot_rewards()
         status, result = self.__redeem_form(form_data)
+        if status == Status.ABORTED:
+            # nothing happened on their side
+            return status
         self.last_status = status
-        _L.debug("{}: {}".format(Status(status), result))
+        metrics.count("shift.status.{}".format(Status(status)))
+        _L.debug("%s: %s", Status(status), result)
         return status
 
+    def snapshot_rewards(self):
+        """Cache the current reward list (once per session)"""
+        if self.old_rewards is None:
+            self.old_rewards = self.__query_rewards()
+        return self.old_rewards
+
+    def unlocked_rewards(self):
+        """Rewards unlocked since `snapshot_rewards` was called"""
+        if self.old_rewards is None:
+            return []
+        new_rewards = self.__query_rewards()
+        old = list(self.old_rewards)
+        ret = []
+        # compare as multiset. The same reward can be unlocked several times
+        for el in new_rewards:
+            if el in old:
+                old.remove(el)
+            else:
+                ret.append(el)
+        return ret
+
     def __save_cookie(self):
         """Save cookie for auto login"""
-        with open(self.cookie_file, "wb") as f:
-            for cookie in self.client.cookies:
-                if cookie.name == "si":
-                    pickle.dump(self.client.cookies, f)
-                    return True
+        for cookie in self.client.cookies:
+            if cookie.name == SESSION_COOKIE:
+                self.session_store.save(store.dump_session(self.client.cookies))
+                return True
         return False
 
     def __load_cookie(self):
-        """Check if there is a saved cookie and load it."""
-        from os import path
-        if not path.exists(self.cookie_file):
+        """Check if there is a saved (and still valid) session and load it."""
+        if not store.load_session(self.session_store.load(),
+                                  self.client.cookies,
+                                  required=SESSION_COOKIE):
+            return False
+        if not self.__probe_session():
+            _L.info("Saved session expired")
+            self.client.cookies.clear()
+            self.session_store.delete()
+            return False
+        return True
+
+    @metrics.timed("shift.probe")
+    def __probe_session(self):
+        """Check if the session is still logged in (one request)
+
+        The probe fetches the redemption page, so we get a CSRF-Token
+        for free."""
+        the_url = "{}/code_redemptions/new".format(self.base_url)
+        r = self.client.get(the_url, allow_redirects=False)
+        _L.debug("%s %s %s", r.request.method, r.url, r.status_code)
+        if r.status_code != 200:
+            # logged out sessions get redirected to the login page
             return False
-        with open(self.cookie_file, "rb") as f:
-            self.client.cookies.update(pickle.load(f))
+        status_code, token = self.__get_token(r)
+        if token:
+            self.token_fetches += 1
+            self.__set_token(token)
         return True
 
+    @metrics.timed("shift.token")
     def __get_token(self, url_or_reply):
         """Get CSRF-Token from given URL"""
         if type(url_or_reply) == str:
             r = self.client.get(url_or_reply)
-            _L.debug("{} {} {}".format(r.request.method, r.url, r.status_code))
+            _L.debug("%s %s %s", r.request.method, r.url, r.status_code)
         else:
             r = url_or_reply
 
-        soup = BSoup(r.text, "html.parser")
-        meta = soup.find("meta", attrs=dict(name="csrf-token"))
-        if not meta:
-            return r.status_code, None
-        return r.status_code, meta["content"]
+        return r.status_code, extract.csrf_token(r.text)
+
+    def __get_cached_token(self, url):
+        """Get CSRF-Token from cache or fetch it from given URL"""
+        if self.__token and (time() - self.__token_time) < self.token_ttl:
+            self.token_fetches_saved += 1
+            return 200, self.__token
+        status_code, token = self.__get_token(url)
+        self.token_fetches += 1
+        if token:
+            self.__set_token(token)
+        return status_code, token
+
+    def __set_token(self, token):
+        self.__token = token
+        self.__token_time = time()
+
+    def __invalidate_token(self):
+        self.__token = None
+        self.__token_time = 0
+
+    def __token_rejected(self, r):
+        """Check if the site rejected our CSRF-Token (or session)"""
+        if r.status_code == 422:
+            return True
+        # rejected requests get redirected to the login page
+        redirects = [r] + list(r.history)
+        for el in redirects:
+            if el.status_code in (301, 302, 303):
+                location = el.headers.get("location", "")
+                if "/home" in location or "/sessions" in location:
+                    return True
+        return False
 
+    @metrics.timed("shift.login")
     def __login(self, user, pw):
         """Login with user/pw"""
-        the_url = "{}/home".format(base_url)
+        the_url = "{}/home".format(self.base_url)
         status_code, token = self.__get_token(the_url)
         if not token:
             return None
@@ -189,48 +404,50 @@ class ShiftClient:
                       "user[email]": user,
                       "user[password]": pw}
         headers = {"Referer": the_url}
-        r = self.client.post("{}/sessions".format(base_url),
+        r = self.client.post("{}/sessions".format(self.base_url),
         # r = self.client.post("{}/sessions".format("http://127.0.0.1:8000"),
                              data=login_data,
                              headers=headers)
-        _L.debug("{} {} {}".format(r.request.method, r.url, r.status_code))
+        _L.debug("%s %s %s", r.request.method, r.url, r.status_code)
         return r
 
-    def __get_redemption_form(self, code, platform):
-        """Get Form data for code redemption"""
-        the_url = "{}/code_redemptions/new".format(base_url)
-        status_code, token = self.__get_token(the_url)
-        if not token:
-            _L.debug("no token")
-            return False, status_code, "Could not retrieve Token"
-
-        r = self.client.get("{base_url}/entitlement_offer_codes?code={code}"
-                            .format(base_url=base_url, **locals()),
-                            headers=json_headers(token))
-
-        _L.debug("{} {} {}".format(r.request.method, r.url, r.status_code))
-        soup = BSoup(r.text, "html.parser")
-        if not soup.find("form", class_="new_archway_code_redemption"):
-            return False, r.status_code, r.text.strip()
-
-        inp = soup.find_all("input", attrs=dict(name="authenticity_token"))
-        form_code = soup.find_all(id="archway_code_redemption_code")
-        check = soup.find_all(id="archway_code_redemption_check")
-        service = soup.find_all(id="archway_code_redemption_service")
-
-        ind = None
-        for i, s in enumerate(service):
-            if platform in s["value"]:
-                ind = i
+    @metrics.timed("shift.lookup")
+    def __lookup_code(self, code):
+        """Get the redemption forms of all services for given code"""
+        the_url = "{}/code_redemptions/new".format(self.base_url)
+        # retry once with a fresh token if the cached one got rejected
+        for _ in range(2):
+            status_code, token = self.__get_cached_token(the_url)
+            if not token:
+                _L.debug("no token")
+                return False, status_code, NO_TOKEN
+
+            r = self.client.get("{base_url}/entitlement_offer_codes?code={code}"
+                                .format(base_url=self.base_url, **locals()),
+                                headers=json_headers(token))
+
+            _L.debug("%s %s %s", r.request.method, r.url, r.status_code)
+            if not self.__token_rejected(r):
                 break
-        if (ind is None):
-            return False, r.status_code, "This code is not available for your platform"
-
-        form_data = {"authenticity_token": inp[ind]["value"],
-                     "archway_code_redemption[code]": form_code[ind]["value"],
-                     "archway_code_redemption[check]": check[ind]["value"],
-                     "archway_code_redemption[service]": service[ind]["value"]}
-        return True, r.status_code, form_data
+            _L.debug("token rejected")
+            self.__invalidate_token()
+        else:
+            # that's no answer about the code
+            return False, r.status_code, TOKEN_REJECTED
+        forms = extract.redemption_forms(r.text)
+        if not forms:
+            return False, r.status_code, r.text.strip()
+        return True, r.status_code, forms
+
+    def __form_data(self, forms, platform):
+        """POST data of the form matching `platform` (or None)"""
+        for form in forms:
+            if form["service"] and platform in form["service"]:
+                return {"authenticity_token": form["authenticity_token"],
+                        "archway_code_redemption[code]": form["code"],
+                        "archway_code_redemption[check]": form["check"],
+                        "archway_code_redemption[service]": form["service"]}
+        return None
 
     def __get_status(self, alert):
         status = Status.NONE
@@ -242,70 +459,96 @@ class ShiftClient:
         return status, alert
 
     def __get_redemption_status(self, r):
-        # return None
-        soup = BSoup(r.text, "lxml")
-        div = soup.find("div", id="check_redemption_status")
-        ret = [None, None, None]
-        if div:
-            ret[0] = div.text.strip()
-            ret[1] = div["data-url"]
-            ret[2] = div["data-fallback-url"]
-        return ret
+        return extract.redemption_status(r.text)
 
     def __check_redemption_status(self, r):
         """Check redemption"""
         import json
-        from time import sleep
+        from time import sleep, perf_counter
         if (r.status_code == 302):
             return Status.REDIRECT, r.headers["location"]
 
         get_status, url, fallback = self.__get_redemption_status(r)
         if get_status:
-            status_code, token = self.__get_token(r)
+            token = self.__token
+            if not token:
+                # the reply carries a fresh token. No need for another request
+                status_code, token = self.__get_token(r)
+                if token:
+                    self.__set_token(token)
+            _L.info(get_status)
+            start = perf_counter()
+            deadline = start + self.poll_schedule["deadline"]
+            delays = poll_delays(**self.poll_schedule)
             cnt = 0
             while True:
-                if cnt > 5:
-                    return Status.REDIRECT, fallback
-                _L.info(get_status)
-                # wait 500
-                _L.debug("get " + "{}/{}".format(base_url, url))
-                raw_json = self.client.get("{}/{}".format(base_url, url),
+                _L.debug("get %s/%s", self.base_url, url)
+                t = perf_counter()
+                raw_json = self.client.get("{}/{}".format(self.base_url, url),
                                            allow_redirects=False,
                                            headers=json_headers(token))
                 data = json.loads(raw_json.text)
+                now = perf_counter()
+                metrics.observe("shift.poll", now - t)
+                self.poll_stats.append((cnt, now - t, now - start,
+                                        "text" in data))
 
                 if "text" in data:
                     get_status = self.__get_status(data["text"])
                     return get_status
 
-                sleep(0.5)
+                delay = next(delays)
+                if now + delay > deadline:
+                    self.poll_fallbacks += 1
+                    return Status.REDIRECT, fallback
+                sleep(delay)
                 cnt += 1
 
         return Status.NONE, None
 
+    @metrics.timed("shift.rewards")
     def __query_rewards(self):
         """Query reward list"""
         # self.old_rewards
-        the_url = "{}/rewards".format(base_url)
+        the_url = "{}/rewards".format(self.base_url)
         r = self.client.get(the_url)
-        soup = BSoup(r.text, "html.parser")
 
         # cache all unlocked rewards
-        return [el.text
-                for el in soup.find_all("div", class_="reward_unlocked")]
+        return extract.unlocked_rewards(r.text)
+
+    def __fresh_form_data(self, data):
+        """Look up the code of form data again (for a new token)"""
+        found, _, forms = self.__lookup_code(
+            data["archway_code_redemption[code]"])
+        if not found:
+            return None
+        return self.__form_data(forms,
+                                data["archway_code_redemption[service]"])
 
     def __redeem_form(self, data):
         """Redeem a code with given form data"""
-        # cache old reward list
-        self.old_rewards = self.__query_rewards()
+        if self.abort is not None and self.abort.is_set():
+            return Status.ABORTED, "Aborted"
 
-        the_url = "{}/code_redemptions".format(base_url)
+        the_url = "{}/code_redemptions".format(self.base_url)
         headers = {"Referer": "{}/new".format(the_url)}
-        r = self.client.post(the_url,
-                             data=data,
-                             headers=headers,
-                             allow_redirects=False)
-        _L.debug("{} {} {}".format(r.request.method, r.url, r.status_code))
+        # retry once with a fresh token (and form) if ours got rejected.
+        # the rejected reply has no status, it's not the redemption limit
+        for retry in range(2):
+            with metrics.timer("shift.post"):
+                r = self.client.post(the_url,
+                                     data=data,
+                                     headers=headers,
+                                     allow_redirects=False)
+            _L.debug("%s %s %s", r.request.method, r.url, r.status_code)
+            if not self.__token_rejected(r):
+                break
+            _L.debug("token rejected")
+            self.__invalidate_token()
+            if not retry:
+                data = self.__fresh_form_data(data)
+            if retry or data is None:
+                return Status.UNKNOWN, TOKEN_REJECTED
         status, redirect = self.__check_redemption_status(r)
         # did we visit /code_redemptions/...... route?
         redemption = False
@@ -313,7 +556,7 @@ class ShiftClient:
         while status == Status.REDIRECT:
             if "code_redemptions/" in redirect:
                 redemption = True
-            _L.debug("redirect to '{}'".format(redirect))
+            _L.debug("redirect to '%s'", redirect)
             r2 = self.client.get(redirect)
             status, redirect = self.__check_redemption_status(r2)
 
@@ -0,0 +1,124 @@
+#############################################################################
+#
+# Copyright (C) 2018 Fabian Schweinfurth
+# Contact: autoshift <at> derfabbi.de
+#
+# This file is part of autoshift
+#
+# autoshift is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autoshift is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with autoshift.  If not, see <http://www.gnu.org/licenses/>.
+#
+#############################################################################
+"""SQLite connection management.
+
+Each thread gets its own connection to the database (sqlite connections
+must not be shared between threads). The database runs in WAL mode, so
+readers don't block the (single) writer and vice versa. Writes happen in
+`transaction()` blocks that take the write lock right away instead of
+failing with "database is locked" halfway through.
+"""
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from common import _L
+
+# applied to each new connection
+PRAGMAS = [
+    ("journal_mode", "WAL"),
+    # durable enough with WAL and a lot less fsyncs
+    ("synchronous", "NORMAL"),
+    ("foreign_keys", "ON"),
+    ("temp_store", "MEMORY"),
+]
+# ms to wait for another connection's write lock
+BUSY_TIMEOUT = 10000
+
+
+class Database:
+    def __init__(self, filename, busy_timeout=BUSY_TIMEOUT):
+        self.filename = filename
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._conns = []
+
+    def _connect(self):
+        # autocommit. transactions are started explicitly (`transaction`)
+        conn = sqlite3.connect(self.filename,
+                               timeout=self.busy_timeout / 1000,
+                               detect_types=sqlite3.PARSE_DECLTYPES,
+                               isolation_level=None,
+                               check_same_thread=False)
+        conn.execute("PRAGMA busy_timeout={:d}".format(self.busy_timeout))
+        for name, value in PRAGMAS:
+            conn.execute("PRAGMA {}={}".format(name, value))
+        _L.debug("opened %s in thread %s", self.filename,
+                 threading.current_thread().name)
+        with self._lock:
+            self._conns.append(conn)
+        return conn
+
+    @property
+    def conn(self):
+        """Connection of the current thread"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+            self._local.depth = 0
+        return conn
+
+    def execute(self, sql, params=()):
+        return self.conn.execute(sql, params)
+
+    def executemany(self, sql, params):
+        return self.conn.executemany(sql, params)
+
+    @contextmanager
+    def transaction(self):
+        """Run the block in a (write) transaction of this thread's connection
+
+        Commits at the end, rolls back on exceptions. Nested blocks are
+        part of the outermost transaction."""
+        conn = self.conn
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield conn
+            finally:
+                self._local.depth -= 1
+            return
+
+        conn.execute("BEGIN IMMEDIATE")
+        self._local.depth = 1
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+        finally:
+            self._local.depth = 0
+
+    def close(self):
+        """Close the connections of all threads"""
+        with self._lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                _L.debug("could not close connection: %s", e)
+        # threads would reconnect on next use
+        self._local = threading.local()
@@ -0,0 +1,146 @@
+#############################################################################
+#
+# Copyright (C) 2018 Fabian Schweinfurth
+# Contact: autoshift <at> derfabbi.de
+#
+# This file is part of autoshift
+#
+# autoshift is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autoshift is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with autoshift.  If not, see <http://www.gnu.org/licenses/>.
+#
+#############################################################################
+"""Small persistent stores for state that has to survive restarts.
+
+A backend stores a single text blob:
+
+    FileBackend(filename)      # local file (default)
+    KVBackend(mapping, key)    # any dict-like key-value store
+
+On top of that the login session (cookie jar) is stored as compact,
+versioned JSON.
+"""
+import json
+from os import path, makedirs, replace
+from time import time
+
+from requests.cookies import create_cookie
+
+SESSION_VERSION = 1
+
+
+class FileBackend:
+    def __init__(self, filename):
+        self.filename = filename
+
+    def load(self):
+        """Stored text or None"""
+        if not path.exists(self.filename):
+            return None
+        with open(self.filename, "r") as f:
+            return f.read()
+
+    def save(self, data):
+        dirname = path.dirname(self.filename)
+        if dirname:
+            makedirs(dirname, exist_ok=True)
+        # write atomically. a crash mustn't leave half a file behind
+        tmp = "{}.tmp".format(self.filename)
+        with open(tmp, "w") as f:
+            f.write(data)
+        replace(tmp, self.filename)
+
+    def delete(self):
+        from os import remove
+        if path.exists(self.filename):
+            remove(self.filename)
+
+
+class KVBackend:
+    """Store in a shared key-value store (anything dict-like)"""
+    def __init__(self, mapping, key):
+        self.mapping = mapping
+        self.key = key
+
+    def load(self):
+        return self.mapping.get(self.key)
+
+    def save(self, data):
+        self.mapping[self.key] = data
+
+    def delete(self):
+        self.mapping.pop(self.key, None)
+
+
+class DynamoDBBackend:
+    """Store in an attribute of a DynamoDB item
+
+    `table` is a boto3 `Table` (or anything with its item methods),
+    `key` the primary key of the item"""
+    def __init__(self, table, key, attribute="data"):
+        self.table = table
+        self.key = key
+        self.attribute = attribute
+
+    def load(self):
+        item = self.table.get_item(Key=self.key).get("Item")
+        return item.get(self.attribute) if item else None
+
+    def save(self, data):
+        self.table.put_item(Item=dict(self.key, **{self.attribute: data}))
+
+    def delete(self):
+        self.table.delete_item(Key=self.key)
+
+
+def dump_session(jar):
+    """Serialize cookie jar"""
+    cookies = [{"name": c.name,
+                "value": c.value,
+                "domain": c.domain,
+                "path": c.path,
+                "expires": c.expires,
+                "secure": c.secure}
+               for c in jar]
+    return json.dumps({"v": SESSION_VERSION,
+                       "saved": int(time()),
+                       "cookies": cookies},
+                      separators=(",", ":"))
+
+
+def load_session(data, jar, required=None):
+    """Load serialized session into cookie jar.
+
+    Returns False if there is no (usable) session, i.e. an unknown
+    version, broken data or if the `required` cookie is missing/expired"""
+    if not data:
+        return False
+    try:
+        session = json.loads(data)
+    except ValueError:
+        return False
+    if not isinstance(session, dict) or session.get("v") != SESSION_VERSION:
+        return False
+
+    now = time()
+    cookies = [c for c in session.get("cookies", [])
+               if not c.get("expires") or c["expires"] > now]
+    if required and required not in [c["name"] for c in cookies]:
+        return False
+
+    for c in cookies:
+        jar.set_cookie(create_cookie(c["name"], c["value"],
+                                     domain=c.get("domain") or "",
+                                     path=c.get("path") or "/",
+                                     expires=c.get("expires"),
+                                     secure=c.get("secure", False)))
+    return True
@@ -0,0 +1,133 @@
+#############################################################################
+#
+# Copyright (C) 2018 Fabian Schweinfurth
+# Contact: autoshift <at> derfabbi.de
+#
+# This file is part of autoshift
+#
+# autoshift is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# autoshift is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with autoshift.  If not, see <http://www.gnu.org/licenses/>.
+#
+#############################################################################
+"""Shared HTTP transport.
+
+All sessions created here share one connection pool (kept alive for the
+lifetime of the process, e.g. across warm Lambda invocations), have
+default connect/read timeouts and retry idempotent requests on
+connection errors and 502/503/504 with exponential backoff.
+
+    s = transport.session()          # own cookie jar, shared pool
+    r = transport.shared_session().get(url)  # for cookie-less fetches
+"""
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+try:
+    from urllib3.util.retry import Retry
+except ImportError:  # pragma: no cover
+    from requests.packages.urllib3.util.retry import Retry
+
+settings = {
+    # number of hosts to keep pools for and connections per host
+    "pool_connections": 4,
+    "pool_maxsize": 10,
+    # (connect, read) timeout in seconds
+    "timeout": (5, 30),
+    # retries of idempotent requests and their backoff factor in seconds
+    "retries": 3,
+    "backoff": 0.5,
+}
+
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS"])
+RETRY_STATUS = (502, 503, 504)
+
+__adapter = None
+__session = None
+
+
+class TimeoutSession(requests.Session):
+    """`requests.Session` with a default timeout"""
+    def __init__(self, timeout=None):
+        super(TimeoutSession, self).__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super(TimeoutSession, self).request(method, url, **kwargs)
+
+
+def configure(**kwargs):
+    """Change `settings`. Sessions created afterwards use a new pool"""
+    global __adapter, __session
+    unknown = set(kwargs) - set(settings)
+    if unknown:
+        raise TypeError("unknown transport settings: {}"
+                        .format(", ".join(sorted(unknown))))
+    settings.update(kwargs)
+    __adapter = None
+    __session = None
+
+
+def retry():
+    """Retry policy for idempotent requests"""
+    kwargs = dict(total=settings["retries"],
+                  backoff_factor=settings["backoff"],
+                  status_forcelist=RETRY_STATUS,
+                  raise_on_status=False)
+    try:
+        return Retry(allowed_methods=IDEMPOTENT_METHODS, **kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=IDEMPOTENT_METHODS, **kwargs)
+
+
+def adapter():
+    """The process wide adapter (and with it the connection pool)"""
+    global __adapter
+    if __adapter is None:
+        __adapter = HTTPAdapter(pool_connections=settings["pool_connections"],
+                                pool_maxsize=settings["pool_maxsize"],
+                                max_retries=retry())
+    return __adapter
+
+
+def count_response(r, *args, **kwargs):
+    """Response hook: count requests and received bytes (see `metrics`)"""
+    metrics.count("http.requests")
+    # don't touch the body. It might be streamed
+    size = r.headers.get("Content-Length")
+    if size and size.isdigit():
+        metrics.count("http.bytes", int(size))
+    if r.status_code >= 500:
+        metrics.count("http.errors")
+    return r
+
+
+def session():
+    """New session with its own cookies on top of the shared pool"""
+    s = TimeoutSession(settings["timeout"])
+    s.hooks["response"].append(count_response)
+    a = adapter()
+    s.mount("https://", a)
+    s.mount("http://", a)
+    return s
+
+
+def shared_session():
+    """Process wide session for requests that don't need cookies"""
+    global __session
+    if __session is None:
+        __session = session()
+    return __session